@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Microbenchmark: per-request config overhead of the webserver.
+
+Compares what every /get and /set used to do before touching the db
+(read and validate KEY, re-read DB_HOST/DB_PORT, parse the port and build
+a client) with resolving the injected, pre-validated settings.
+
+No database is needed: no command is ever sent.
+
+    python benchmarks/bench_settings.py [-n ITERATIONS]
+"""
+import argparse
+import os
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'webserver' / 'src' / 'resources'))
+
+import redis  # noqa: E402
+
+import webserver  # noqa: E402
+
+
+def per_request_env():
+    """The old path: check_key() followed by client()."""
+    key = os.environ.get('KEY')
+    if not key:
+        raise RuntimeError('KEY unset')
+    {"message": "ready", "*KEY*": key}
+    db_port = os.environ.get('DB_PORT')
+    db_host = os.environ.get('DB_HOST')
+    if not (db_host and db_port):
+        raise RuntimeError('required envvars unset')
+    return redis.Redis(host=db_host, port=int(db_port))
+
+
+def injected_settings():
+    """The new path: the cached settings dependency and pooled client."""
+    return webserver.client(webserver.get_settings())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=100_000)
+    args = parser.parse_args()
+
+    os.environ.update(KEY='secret', DB_HOST='127.0.0.1', DB_PORT='6379')
+    results = {}
+    for fn in (per_request_env, injected_settings):
+        best = min(timeit.repeat(fn, number=args.iterations, repeat=5))
+        results[fn.__name__] = best / args.iterations * 1e6
+        print(f'{fn.__name__:>20}: {results[fn.__name__]:8.3f} us/request')
+    saved = results['per_request_env'] - results['injected_settings']
+    print(f'{"saved":>20}: {saved:8.3f} us/request '
+          f'({results["per_request_env"] / results["injected_settings"]:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
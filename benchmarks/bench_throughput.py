@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Throughput benchmark for webserver.py against a local KeyDB/Redis.
+
+Starts a throwaway `keydb-server` (or `redis-server`) and the webserver
+as plain processes, no Juju involved, then hammers each endpoint at
+several concurrency levels and value sizes. For every combination it
+records requests/sec and p50/p95/p99 latency, and writes them as json.
+
+Given a baseline, the run fails if any combination got slower than the
+baseline by more than the threshold. A missing baseline is an error too:
+recording one is an explicit step, with --update-baseline.
+
+    python benchmarks/bench_throughput.py --output results.json \\
+        --baseline benchmarks/baseline.json --threshold 0.25
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+WEBSERVER = Path(__file__).parent.parent / 'webserver' / 'src' / 'resources' / 'webserver.py'
+DB_SERVERS = ('keydb-server', 'redis-server')
+KEYSPACE = 1000  # distinct keys each workload cycles through
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(check: Callable[[], bool], what: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except (OSError, httpx.HTTPError):
+            pass
+        time.sleep(.1)
+    raise TimeoutError(f'{what} did not come up within {timeout}s')
+
+
+@contextmanager
+def _process(cmd: List[str], **kwargs):
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, **kwargs)
+    try:
+        yield proc
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+@contextmanager
+def db_server(binary: str):
+    port = _free_port()
+    cmd = [binary, '--port', str(port), '--bind', '127.0.0.1',
+           '--save', '', '--appendonly', 'no']
+    with _process(cmd):
+        _wait_for(lambda: socket.create_connection(('127.0.0.1', port), 1).close() or True,
+                  binary)
+        yield port
+
+
+@contextmanager
+def webserver(db_port: int, env: Dict[str, str]):
+    port = _free_port()
+    env = {**os.environ, 'KEY': 'benchmark', 'PORT': str(port),
+           'DB_HOST': '127.0.0.1', 'DB_PORT': str(db_port),
+           # access logs would mostly measure the terminal
+           'ACCESS_LOG_SAMPLE_RATE': '0', **env}
+    with _process([sys.executable, str(WEBSERVER)], env=env, cwd=WEBSERVER.parent):
+        url = f'http://127.0.0.1:{port}'
+        _wait_for(lambda: httpx.get(f'{url}/readyz').status_code == 200, 'webserver')
+        yield url
+
+
+# workload name -> (request factory(client, request index, value),
+#                   check(response json, value)). The webserver answers db
+# errors with a 200 and the error message, so the body is what tells
+# a success from a failure.
+WORKLOADS = {
+    'get': (lambda client, i, value: client.get(f'/get/key{i % KEYSPACE}'),
+            lambda body, value: body == value),
+    # every request on one key: exercises read coalescing
+    'get-hot': (lambda client, i, value: client.get('/get/key0'),
+                lambda body, value: body == value),
+    'set': (lambda client, i, value: client.post(f'/set/key{i % KEYSPACE}/{value}'),
+            lambda body, value: body == 'ok'),
+    # bulk: one page of a keyspace listing
+    'keys': (lambda client, i, value: client.get('/keys', params={'prefix': 'key1', 'count': 100}),
+             lambda body, value: isinstance(body, dict) and 'keys' in body),
+}
+
+
+async def _seed(url: str, value: str):
+    async with httpx.AsyncClient(base_url=url) as client:
+        for i in range(KEYSPACE):
+            resp = await client.post(f'/set/key{i}/{value}')
+            if resp.json() != 'ok':
+                raise RuntimeError(f'seeding key{i} failed: {resp.text}')
+
+
+async def run_workload(url: str, workload: str, concurrency: int,
+                       value_size: int, requests: int) -> dict:
+    value = 'x' * value_size
+    if workload != 'set':
+        await _seed(url, value)
+
+    request, check = WORKLOADS[workload]
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    resp = await request(client, i, value)
+                    resp.raise_for_status()
+                    if not check(resp.json(), value):
+                        errors += 1
+                except (httpx.HTTPError, ValueError):
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'workload': workload,
+        'concurrency': concurrency,
+        'value_size': value_size,
+        'requests': requests,
+        'errors': errors,
+        'rps': requests / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+    }
+
+
+def _cell(result: dict) -> tuple:
+    return result['workload'], result['concurrency'], result['value_size']
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    """Describe every result that regressed past `threshold` against the baseline."""
+    reference = {_cell(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get(_cell(result))
+        if base is None:
+            continue
+        name = '{}/c={}/size={}'.format(*_cell(result))
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"{name}: {result['rps']:.0f} req/s, "
+                               f"baseline {base['rps']:.0f} req/s")
+        if result['p99_ms'] > base['p99_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.2f}ms, "
+                               f"baseline {base['p99_ms']:.2f}ms")
+        if result['errors'] > base['errors']:
+            regressions.append(f"{name}: {result['errors']} errors, "
+                               f"baseline {base['errors']}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-server', help='keydb-server/redis-server binary; '
+                                            'found on PATH by default')
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS),
+                        choices=list(WORKLOADS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--value-sizes', nargs='+', type=int, default=[16, 256, 4096])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per workload/concurrency/value size')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='extra webserver environment variables')
+    parser.add_argument('--output', type=Path, default=Path('bench_output.json'))
+    parser.add_argument('--baseline', type=Path)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='tolerated relative regression against the baseline')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+    if args.baseline and not args.update_baseline and not args.baseline.exists():
+        parser.error(f'no baseline at {args.baseline}; '
+                     'record one on this machine with --update-baseline')
+
+    binary = args.db_server or next(filter(None, map(shutil.which, DB_SERVERS)), None)
+    if not binary:
+        parser.error(f'none of {DB_SERVERS} found on PATH; pass --db-server')
+    env = dict(var.split('=', 1) for var in args.env)
+
+    results = []
+    with db_server(binary) as db_port, webserver(db_port, env) as url:
+        for workload in args.workloads:
+            for concurrency in args.concurrency:
+                for value_size in args.value_sizes:
+                    result = asyncio.run(run_workload(
+                        url, workload, concurrency, value_size, args.requests))
+                    print('{workload:>8} c={concurrency:<3} size={value_size:<6} '
+                          '{rps:8.0f} req/s  p50 {p50_ms:6.2f}ms  '
+                          'p95 {p95_ms:6.2f}ms  p99 {p99_ms:6.2f}ms  '
+                          'errors {errors}'.format(**result))
+                    results.append(result)
+
+    report = {
+        'meta': {'db_server': binary, 'python': platform.python_version(),
+                 'machine': platform.machine(), 'env': env,
+                 'timestamp': time.time()},
+        'results': results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f'results written to {args.output}')
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        failed = [result for result in results if result['errors']]
+        if failed:
+            print(f'not writing a baseline from a run with errors: {failed}')
+            return 1
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f'baseline written to {args.baseline}')
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())['results']
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,21 +2,84 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import datetime
+import ipaddress
+import json
 import logging
+from typing import Dict, Optional
+
+import redis
 from charms.keydb.v0.db import DBProvider
-from ops.charm import CharmBase
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from ops.charm import CharmBase, RelationEvent
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, WaitingStatus
+from ops.model import ActiveStatus, BlockedStatus, Container, WaitingStatus
 from ops.pebble import Layer
 
 
 logger = logging.getLogger(__name__)
 
+EXPORTER_PORT = 9121
+TLS_DIR = '/etc/keydb/tls'
+TLS_FILES = ('ca.crt', 'server.crt', 'server.key')
+
+
+def _certificate(subject: str, public_key, issuer: str, signing_key, *,
+                 ca: bool, san: x509.GeneralName = None) -> x509.Certificate:
+    now = datetime.datetime.utcnow()
+    builder = (x509.CertificateBuilder()
+               .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)]))
+               .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer)]))
+               .public_key(public_key)
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(now - datetime.timedelta(minutes=5))
+               .not_valid_after(now + datetime.timedelta(days=3650))
+               .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+    if san is not None:
+        builder = builder.add_extension(x509.SubjectAlternativeName([san]), critical=False)
+    return builder.sign(signing_key, hashes.SHA256())
+
+
+def _pem(obj) -> str:
+    if isinstance(obj, x509.Certificate):
+        return obj.public_bytes(serialization.Encoding.PEM).decode()
+    return obj.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption()).decode()
+
+
+def generate_certificates(host: str) -> Dict[str, str]:
+    """A self-signed CA, and a server certificate it signed for `host`."""
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_cert = _certificate('keydb-ca', ca_key.public_key(), 'keydb-ca', ca_key, ca=True)
+
+    server_key = ec.generate_private_key(ec.SECP256R1())
+    try:
+        san = x509.IPAddress(ipaddress.ip_address(host))
+    except ValueError:
+        san = x509.DNSName(host)
+    server_cert = _certificate(host, server_key.public_key(), 'keydb-ca', ca_key,
+                               ca=False, san=san)
+    return {'host': host, 'ca.crt': _pem(ca_cert),
+            'server.crt': _pem(server_cert), 'server.key': _pem(server_key)}
+
 
 class KeyDBCharm(CharmBase):
+    _stored = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(certificates={}, certificates_rotated=False)
         self.framework.observe(self.on.keydb_pebble_ready, self._on_keydb_pebble_ready)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.exporter_pebble_ready, self._on_exporter_pebble_ready)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.metrics_endpoint_relation_joined,
+                               self._on_metrics_endpoint_relation_joined)
 
         host = self.model.get_binding("juju-info").network.bind_address
 
@@ -40,31 +103,88 @@ class KeyDBCharm(CharmBase):
         assert isinstance(host, str), host
         assert isinstance(port, int), port
 
-        self.db = DBProvider(self, host, port)
+        self._host = host
+        self.db = DBProvider(self, host, port, **self._tls_endpoint())
+
+    def _tls_endpoint(self) -> dict:
+        """The TLS port and the CA to publish, if TLS is on."""
+        tls_port = self.config['tls-port']
+        if not tls_port:
+            return {'tls_port': None, 'ca': None}
+        return {'tls_port': tls_port, 'ca': self._certificates['ca.crt']}
+
+    @property
+    def _certificates(self) -> Dict[str, str]:
+        """The self-signed TLS material; generated again if the host changed.
+
+        Kept in stored state, private key included, where anyone able to
+        read the unit's state can get it; a Juju secret would be better
+        once the supported Juju and ops versions have them.
+        """
+        if self._stored.certificates.get('host') != self._host:
+            self._stored.certificates = generate_certificates(self._host)
+            # to be pushed and published by the next hook that can
+            self._stored.certificates_rotated = True
+        return dict(self._stored.certificates)
 
     def _on_keydb_pebble_ready(self, event):
         container = event.workload
-        # Create a new config layer.
-
         if container.can_connect():
-            # Get the current layer.
-            current_layer = container.get_plan()
-            # Check if there are any changes to layer services.
-            new_layer = self._keydb_layer()
-            if current_layer.services != new_layer.services:
-                # Changes were made, add the new layer.
-                container.add_layer('keydb', new_layer, combine=True)
-                logging.info("Added updated layer 'keydb' to Pebble plan")
-                # Restart it and report a new status to Juju.
-                container.restart('keydb')
-                logging.info("Restarted keydb service")
-
+            self._reconfigure(container)
             # All is well, set an ActiveStatus.
             self.unit.status = ActiveStatus()
         else:
             self.unit.status = WaitingStatus(
                 "waiting for Pebble in workload container")
 
+    def _on_config_changed(self, _):
+        container = self.unit.get_container('keydb')
+        if container.can_connect():
+            self._reconfigure(container)
+        else:
+            # pebble-ready will configure the container
+            self._publish()
+
+    def _reconfigure(self, container: Container):
+        """Bring keydb and the db relations in line with config and certificates."""
+        self._configure_keydb(container)
+        self._publish()
+        self._stored.certificates_rotated = False
+
+    def _configure_keydb(self, container: Container):
+        """Push the TLS material and the layer; restart keydb if either changed."""
+        restart = False
+        if self.config['tls-port']:
+            certificates = self._certificates
+            for name in TLS_FILES:
+                path = f'{TLS_DIR}/{name}'
+                if _read_file(container, path) != certificates[name]:
+                    container.push(path, certificates[name],
+                                   make_dirs=True, permissions=0o600)
+                    restart = True
+
+        # Get the current layer.
+        current_layer = container.get_plan()
+        # Check if there are any changes to layer services.
+        new_layer = self._keydb_layer()
+        if current_layer.services != new_layer.services:
+            # Changes were made, add the new layer.
+            container.add_layer('keydb', new_layer, combine=True)
+            logging.info("Added updated layer 'keydb' to Pebble plan")
+            restart = True
+
+        if restart:
+            container.restart('keydb')
+            logging.info("Restarted keydb service")
+
+    def _publish(self):
+        """Republish the endpoint, TLS port and CA on every db relation."""
+        if not self.unit.is_leader():
+            return
+        self.db.update(self._host, int(self.config['port']), **self._tls_endpoint())
+        for relation in self.model.relations['db']:
+            self.db.offer(relation)
+
     def _keydb_layer(self) -> Layer:
         """Returns a Pebble configuration layer for KeyDB."""
         config = self.config
@@ -72,6 +192,14 @@ class KeyDBCharm(CharmBase):
         require_pass = config.get('requirepass')
         if require_pass:
             args += f"--requirepass {require_pass}"
+        if config['tls-port']:
+            # clients are authenticated by password, not certificate;
+            # the session cache lets reconnecting clients skip the full handshake.
+            args += (f" --tls-port {config['tls-port']}"
+                     f" --tls-cert-file {TLS_DIR}/server.crt"
+                     f" --tls-key-file {TLS_DIR}/server.key"
+                     f" --tls-ca-cert-file {TLS_DIR}/ca.crt"
+                     " --tls-auth-clients no --tls-session-caching yes")
         cmd = f"keydb-server /etc/keydb/keydb.conf {args}"
         logger.debug(cmd)
 
@@ -89,6 +217,112 @@ class KeyDBCharm(CharmBase):
         }
         return Layer(layer_config)
 
+    def _on_exporter_pebble_ready(self, event):
+        container = event.workload
+        if container.can_connect():
+            current_layer = container.get_plan()
+            new_layer = self._exporter_layer()
+            if current_layer.services != new_layer.services:
+                container.add_layer('exporter', new_layer, combine=True)
+                logging.info("Added updated layer 'exporter' to Pebble plan")
+                container.replan()
+                logging.info("Restarted exporter service")
+
+    def _exporter_layer(self) -> Layer:
+        """Returns a Pebble configuration layer for the KeyDB metrics exporter."""
+        environment = {
+            'REDIS_ADDR': f"redis://localhost:{self.config['port']}",
+            'REDIS_EXPORTER_WEB_LISTEN_ADDRESS': f':{EXPORTER_PORT}',
+        }
+        require_pass = self.config.get('requirepass')
+        if require_pass:
+            environment['REDIS_PASSWORD'] = require_pass
+
+        layer_config = {
+            "summary": "exporter layer",
+            "description": "pebble config layer for the keydb metrics exporter",
+            "services": {
+                'exporter': {
+                    "override": "replace",
+                    "summary": "prometheus exporter for keydb",
+                    "command": "/redis_exporter",
+                    "startup": "enabled",
+                    "environment": environment,
+                }
+            },
+        }
+        return Layer(layer_config)
+
+    def _on_metrics_endpoint_relation_joined(self, event: RelationEvent):
+        """Tell prometheus where to scrape the exporter of each unit."""
+        relation = event.relation
+        relation.data[self.unit]['prometheus_scrape_unit_address'] = self._host
+        relation.data[self.unit]['prometheus_scrape_unit_name'] = self.unit.name
+        if self.unit.is_leader():
+            relation.data[self.app]['scrape_jobs'] = json.dumps([{
+                'metrics_path': '/metrics',
+                'static_configs': [{'targets': [f'*:{EXPORTER_PORT}']}],
+            }])
+            relation.data[self.app]['scrape_metadata'] = json.dumps({
+                'model': self.model.name,
+                'model_uuid': self.model.uuid,
+                'application': self.app.name,
+                'unit': self.unit.name,
+                'charm_name': self.meta.name,
+            })
+
+    def _collect_stats(self) -> dict:
+        """Scrape KeyDB for memory, eviction and slow command figures."""
+        client = redis.Redis(host='localhost', port=self.config['port'],
+                             password=self.config.get('requirepass') or None,
+                             socket_timeout=5)
+        return {
+            'memory': client.info('memory'),
+            'stats': client.info('stats'),
+            'memory_stats': client.memory_stats(),
+            'slowlog': client.slowlog_get(self.config['slowlog-entries']),
+        }
+
+    def _on_update_status(self, _):
+        container = self.unit.get_container('keydb')
+        if not container.can_connect():
+            return
+        if self._stored.certificates_rotated:
+            # the host changed, in a hook which could not act on it
+            self._reconfigure(container)
+        try:
+            stats = self._collect_stats()
+        except redis.RedisError as e:
+            logger.error('unable to collect keydb stats: %s', e)
+            self.unit.status = WaitingStatus('keydb is not responding')
+            return
+
+        memory = stats['memory']
+        evicted = stats['stats'].get('evicted_keys', 0)
+        logger.info('keydb memory: used %s, fragmentation ratio %s, '
+                    'dataset %s%%, evicted keys %s',
+                    memory.get('used_memory_human'),
+                    memory.get('mem_fragmentation_ratio'),
+                    stats['memory_stats'].get('dataset.percentage'), evicted)
+        for entry in stats['slowlog']:
+            logger.info('keydb slowlog: %sus %s', entry['duration'], entry['command'])
+
+        used, maxmemory = memory.get('used_memory', 0), memory.get('maxmemory', 0)
+        threshold = self.config['memory-warning-threshold']
+        if maxmemory and used >= threshold * maxmemory:
+            self.unit.status = BlockedStatus(
+                f'memory at {used / maxmemory:.0%} of maxmemory; '
+                f'{evicted} keys evicted so far')
+        else:
+            self.unit.status = ActiveStatus()
+
+
+def _read_file(container: Container, path: str) -> Optional[str]:
+    """The contents of `path` in the container, or None if it does not exist."""
+    if not container.exists(path):
+        return None
+    return container.pull(path).read()
+
 
 if __name__ == "__main__":  # pragma: no cover
     main(KeyDBCharm)
@@ -0,0 +1,55 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Hook latency and cost of the keydb charm through its whole lifecycle.
+# Set HOOK_PROFILE_DIR to keep the per-event cProfile dumps.
+
+import os
+from pathlib import Path
+
+import pytest
+
+import ops.testing
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+from ops.testing import Harness
+from charm import KeyDBCharm
+from hook_profiler import HookProfiler
+from test_keydb_charm_unit import network_mock
+
+
+@pytest.fixture
+def profiler(mocker, tmp_path):
+    harness = Harness(KeyDBCharm)
+    harness.update_config({"port": 70, "appendonly": "no"})
+    mocker.patch.object(harness._backend, 'network_get', return_value=network_mock)
+    harness.set_leader(True)
+    harness.begin()
+    profiler = HookProfiler(harness)
+
+    harness.container_pebble_ready('keydb')
+    relation_id = harness.add_relation('db', 'remote')
+    harness.add_relation_unit(relation_id, 'remote/0')
+    harness.update_relation_data(relation_id, 'remote', {'hello': 'there'})
+    harness.update_config({'appendonly': 'yes'})
+    harness.remove_relation(relation_id)
+
+    yield profiler
+    print(profiler.report())
+    profiler.dump(Path(os.environ.get('HOOK_PROFILE_DIR', tmp_path)))
+    harness.cleanup()
+
+
+def test_all_hooks_profiled(profiler: HookProfiler):
+    assert {'keydb_pebble_ready', 'db_relation_created', 'db_relation_changed',
+            'config_changed', 'db_relation_broken'} <= set(profiler.stats)
+
+
+def test_pebble_ready_plans_once(profiler: HookProfiler):
+    assert profiler.stats['keydb_pebble_ready'].pebble['add_layer'] <= 1
+
+
+def test_relation_created_publishes_once(profiler: HookProfiler):
+    created = profiler.stats['db_relation_created']
+    assert created.hook_tools['relation_set'] <= 2  # host and port
@@ -3,9 +3,13 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+
 import pytest
+import redis
 import yaml
-from ops.model import ActiveStatus
+from cryptography import x509
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 
 import ops.testing
 
@@ -74,3 +78,134 @@ def test_relation_data(harness: Harness[KeyDBCharm]):
     assert data['host'] == host
     assert data['port'] == '70'
 
+
+
+def test_exporter_plan(harness: Harness[KeyDBCharm]):
+    harness.container_pebble_ready("exporter")
+    plan = harness.get_container_pebble_plan("exporter")
+    service = plan.to_dict()['services']['exporter']
+    assert service['command'] == '/redis_exporter'
+    assert service['environment']['REDIS_ADDR'] == 'redis://localhost:70'
+
+
+def test_metrics_endpoint_relation(harness: Harness[KeyDBCharm]):
+    harness.set_leader(True)
+    rel_id = harness.add_relation('metrics-endpoint', 'prometheus')
+    harness.add_relation_unit(rel_id, 'prometheus/0')
+    app_data = harness.get_relation_data(rel_id, harness.charm.app)
+    unit_data = harness.get_relation_data(rel_id, harness.charm.unit)
+    jobs = json.loads(app_data['scrape_jobs'])
+    assert jobs[0]['static_configs'][0]['targets'] == ['*:9121']
+    assert unit_data['prometheus_scrape_unit_address'] == '0.0.0.42'
+
+
+@pytest.fixture
+def keydb_client(mocker):
+    client = mocker.patch('charm.redis.Redis').return_value
+    client.info.side_effect = lambda section: {
+        'memory': {'used_memory': 50, 'maxmemory': 100,
+                   'used_memory_human': '50B', 'mem_fragmentation_ratio': 1.5},
+        'stats': {'evicted_keys': 0},
+    }[section]
+    client.memory_stats.return_value = {'dataset.percentage': 42.0}
+    client.slowlog_get.return_value = [{'duration': 20000, 'command': b'KEYS *'}]
+    return client
+
+
+def test_update_status_memory_ok(harness: Harness[KeyDBCharm], keydb_client):
+    harness.container_pebble_ready("keydb")
+    harness.charm.on.update_status.emit()
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+    keydb_client.slowlog_get.assert_called_once_with(10)
+
+
+def test_update_status_memory_pressure(harness: Harness[KeyDBCharm], keydb_client):
+    harness.container_pebble_ready("keydb")
+    harness.update_config({'memory-warning-threshold': 0.4})
+    harness.charm.on.update_status.emit()
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    assert 'memory at 50%' in harness.charm.unit.status.message
+
+
+def test_update_status_keydb_down(harness: Harness[KeyDBCharm], keydb_client):
+    harness.container_pebble_ready("keydb")
+    keydb_client.info.side_effect = redis.ConnectionError('refused')
+    harness.charm.on.update_status.emit()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+
+
+@pytest.fixture
+def tls_harness(mocker):
+    harness = Harness(KeyDBCharm)
+    harness.update_config({"port": "70", "appendonly": "no", "tls-port": 71})
+    mocker.patch.object(harness._backend, 'network_get', return_value=network_mock)
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+def test_tls_plan(tls_harness: Harness[KeyDBCharm]):
+    tls_harness.container_pebble_ready("keydb")
+    command = tls_harness.get_container_pebble_plan("keydb").to_dict()['services']['keydb']['command']
+    assert "--tls-port 71" in command
+    assert "--tls-cert-file /etc/keydb/tls/server.crt" in command
+    assert "--tls-session-caching yes" in command
+
+    container = tls_harness.model.unit.get_container("keydb")
+    ca = container.pull('/etc/keydb/tls/ca.crt').read()
+    assert ca == tls_harness.charm.db._ca
+
+
+def test_tls_certificates_reused(tls_harness: Harness[KeyDBCharm]):
+    first = tls_harness.charm._certificates
+    assert first == tls_harness.charm._certificates
+
+    cert = x509.load_pem_x509_certificate(first['server.crt'].encode())
+    san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert [str(ip) for ip in san.get_values_for_type(x509.IPAddress)] == ['0.0.0.42']
+
+
+def test_tls_enabled_after_deploy(harness: Harness[KeyDBCharm]):
+    harness.set_leader(True)
+    harness.container_pebble_ready("keydb")
+    rel_id = harness.add_relation('db', 'remote')
+    data = harness.get_relation_data(rel_id, harness.charm.app)
+    assert 'tls-port' not in data
+
+    harness.update_config({"tls-port": 71})
+    command = harness.get_container_pebble_plan("keydb").to_dict()['services']['keydb']['command']
+    assert "--tls-port 71" in command
+    container = harness.model.unit.get_container("keydb")
+    # republished on the existing relation, where the webserver reads it
+    data = harness.get_relation_data(rel_id, harness.charm.app)
+    assert data['host'] == '0.0.0.42'
+    assert data['tls-port'] == '71'
+    assert data['ca'] == container.pull('/etc/keydb/tls/ca.crt').read()
+
+    harness.update_config({"tls-port": 0})
+    data = harness.get_relation_data(rel_id, harness.charm.app)
+    assert not data.get('tls-port')
+    assert not data.get('ca')
+
+
+def test_tls_certificates_follow_host(tls_harness: Harness[KeyDBCharm], keydb_client):
+    tls_harness.set_leader(True)
+    tls_harness.container_pebble_ready("keydb")
+    rel_id = tls_harness.add_relation('db', 'remote')
+    container = tls_harness.model.unit.get_container("keydb")
+    old_ca = container.pull('/etc/keydb/tls/ca.crt').read()
+
+    # a later hook finds the unit on a new address
+    tls_harness.charm._host = '0.0.0.43'
+    tls_harness.charm._tls_endpoint()
+    assert tls_harness.charm._stored.certificates_rotated
+    tls_harness.charm.on.update_status.emit()
+
+    ca = container.pull('/etc/keydb/tls/ca.crt').read()
+    assert ca != old_ca
+    assert tls_harness.get_relation_data(rel_id, tls_harness.charm.app)['ca'] == ca
+    cert = x509.load_pem_x509_certificate(
+        container.pull('/etc/keydb/tls/server.crt').read().encode())
+    san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert [str(ip) for ip in san.get_values_for_type(x509.IPAddress)] == ['0.0.0.43']
+    assert not tls_harness.charm._stored.certificates_rotated
@@ -0,0 +1,118 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Measure what each hook costs a charm driven by `ops.testing.Harness`.
+
+For every hook (an event emitted from outside the charm, together with
+whatever custom events it emits in turn) the profiler records wall time,
+the simulated hook tool calls (relation-get, network-get, ...) and the
+Pebble API calls, and keeps a cProfile per event kind, which `dump` writes
+as `<event kind>.prof` files for `python -m pstats` or snakeviz.
+"""
+
+import cProfile
+import functools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+from ops.testing import Harness
+
+# harness backend methods which do not stand for a hook tool
+_NOT_HOOK_TOOLS = {'get_pebble', 'log_split', 'update_relation_data'}
+
+
+@dataclass
+class HookStats:
+    """Totals over all the hooks of one event kind."""
+    count: int = 0
+    wall_time: float = 0.0
+    hook_tools: Counter = field(default_factory=Counter)
+    pebble: Counter = field(default_factory=Counter)
+
+    def per_hook(self, counter: Counter) -> float:
+        return sum(counter.values()) / self.count
+
+
+class HookProfiler:
+    """Profile the hooks of `harness`; attach it right after `harness.begin()`."""
+
+    def __init__(self, harness: Harness):
+        self.stats: Dict[str, HookStats] = {}
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        self._current: Optional[HookStats] = None
+
+        backend = harness._backend
+        for name in dir(backend):
+            attr = getattr(backend, name)
+            if not name.startswith('_') and callable(attr) and name not in _NOT_HOOK_TOOLS:
+                setattr(backend, name, self._counting(attr, 'hook_tools', name))
+        self._wrapped_clients = set()
+        for client in backend._pebble_clients.values():
+            self._wrap_client(client)
+        backend.get_pebble = self._wrap_get_pebble(backend.get_pebble)
+
+        framework = harness.framework
+        framework._emit = self._profiling(framework._emit)
+
+    def _counting(self, method, counter: str, name: str):
+        def wrapper(*args, **kwargs):
+            if self._current is not None:
+                getattr(self._current, counter)[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def _wrap_client(self, client):
+        if id(client) in self._wrapped_clients:
+            return
+        for name in dir(client):
+            attr = getattr(client, name)
+            if not name.startswith('_') and callable(attr):
+                setattr(client, name, self._counting(attr, 'pebble', name))
+        self._wrapped_clients.add(id(client))
+
+    def _wrap_get_pebble(self, get_pebble):
+        @functools.wraps(get_pebble)
+        def wrapper(*args, **kwargs):
+            client = get_pebble(*args, **kwargs)
+            self._wrap_client(client)
+            return client
+        return wrapper
+
+    def _profiling(self, emit):
+        @functools.wraps(emit)
+        def wrapper(event):
+            if self._current is not None:
+                # a custom event emitted by a handler: part of the same hook
+                return emit(event)
+
+            kind = event.handle.kind
+            stats = self._current = self.stats.setdefault(kind, HookStats())
+            profile = self._profiles.setdefault(kind, cProfile.Profile())
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                return emit(event)
+            finally:
+                profile.disable()
+                stats.wall_time += time.perf_counter() - start
+                stats.count += 1
+                self._current = None
+        return wrapper
+
+    def dump(self, output_dir: Path):
+        """Write one cProfile stats file per event kind to `output_dir`."""
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for kind, profile in self._profiles.items():
+            profile.dump_stats(str(output_dir / f'{kind}.prof'))
+
+    def report(self) -> str:
+        lines = [f"{'event':<28}{'hooks':>6}{'ms/hook':>10}{'tools/hook':>12}{'pebble/hook':>13}"]
+        for kind, stats in self.stats.items():
+            lines.append(f'{kind:<28}{stats.count:>6}'
+                         f'{stats.wall_time / stats.count * 1000:>10.2f}'
+                         f'{stats.per_hook(stats.hook_tools):>12.1f}'
+                         f'{stats.per_hook(stats.pebble):>13.1f}')
+        return '\n'.join(lines)
+
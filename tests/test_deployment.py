@@ -94,6 +94,15 @@ async def test_webservers_ready(ws_addresses: List[str]):
         assert json.loads(home.text)['message'] == "ready"
 
 
+@mark.abort_on_fail
+async def test_webservers_probes(ws_addresses: List[str]):
+    """Verify that all webserver units are live and can reach the db."""
+    for ws_addr in ws_addresses:
+        url = f"http://{ws_addr}:{WS_PORT}"
+        assert requests.get(f"{url}/healthz").status_code == 200
+        assert requests.get(f"{url}/readyz").status_code == 200
+
+
 @pytest.mark.parametrize("key, val", (('foo', 'bar'),
                                       ('baz', 'qux')))
 async def test_webservers_storage_with_db(ws_addresses: List[str],
@@ -5,6 +5,7 @@ the db interface.
 """
 
 import logging
+from typing import NamedTuple, Optional
 
 from ops.charm import CharmEvents, RelationEvent, CharmBase, \
     RelationCreatedEvent
@@ -19,21 +20,32 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 1
+LIBPATCH = 5
 
 logger = logging.getLogger(__name__)
 
 
 class DBProvider(Object):
-    def __init__(self, charm: CharmBase, host: str, port: int, key: str = 'db'):
+    def __init__(self, charm: CharmBase, host: str, port: int, key: str = 'db',
+                 tls_port: Optional[int] = None, ca: Optional[str] = None):
         super().__init__(charm, key)
         self.charm = charm
         self._host = host
         self._port = port
+        self._tls_port = tls_port
+        self._ca = ca
 
         self.framework.observe(charm.on.db_relation_created,
                                self._on_db_relation_created)
 
+    def update(self, host: str, port: int, tls_port: Optional[int] = None,
+               ca: Optional[str] = None):
+        """Change the endpoint; published by the next `offer`."""
+        self._host = host
+        self._port = port
+        self._tls_port = tls_port
+        self._ca = ca
+
     @property
     def ready(self):
         if self._host and self._port:
@@ -55,26 +67,48 @@ class DBProvider(Object):
 
         app_databag['host'] = self._host
         app_databag['port'] = str(self._port)
+        # publish the TLS endpoint and the CA to verify it with, if any
+        if self._tls_port:
+            app_databag['tls-port'] = str(self._tls_port)
+            app_databag['ca'] = self._ca
+        else:
+            app_databag.pop('tls-port', None)
+            app_databag.pop('ca', None)
+
+
+class DBEndpoint(NamedTuple):
+    """Validated db connection data, as published by the provider."""
+    host: str
+    port: int
+    tls_port: Optional[int] = None
+    ca: Optional[str] = None
 
 
 class ReadyEvent(RelationEvent):
     """Redis is ready."""
 
-    def __init__(self, handle: Handle, relation, host, port):
+    def __init__(self, handle: Handle, relation, host, port,
+                 tls_port=None, ca=None):
         super().__init__(handle, relation)
         self.host = host
         self.port = port
+        self.tls_port = tls_port
+        self.ca = ca
 
     def snapshot(self) -> dict:
         dct = super().snapshot()
         dct['host'] = self.host
         dct['port'] = self.port
+        dct['tls_port'] = self.tls_port
+        dct['ca'] = self.ca
         return dct
 
     def restore(self, snapshot: dict) -> None:
         super().restore(snapshot)
         self.host = snapshot['host']
         self.port = snapshot['port']
+        self.tls_port = snapshot.get('tls_port')
+        self.ca = snapshot.get('ca')
 
 
 class BrokenEvent(RelationEvent):
@@ -89,42 +123,65 @@ class RedisRelationCharmEvents(CharmEvents):
 class DBRequirer(Object):
     on = RedisRelationCharmEvents()
 
+    # marks an endpoint that has not been read yet in this hook
+    _UNREAD = object()
+
     def __init__(self, charm: CharmBase, key: str = 'db'):
         super().__init__(charm, key)
         self.charm = charm
+        self._key = key
+        self._endpoint = self._UNREAD
         evts = charm.on[key]
+        # any db relation event may mean the remote data has changed
+        for evt in (evts.relation_created, evts.relation_joined,
+                    evts.relation_departed, evts.relation_broken):
+            self.framework.observe(evt, self._invalidate)
         self.framework.observe(evts.relation_changed, self._on_db_relation_changed)
 
     @property
     def relation(self):
-        db_relations = self.charm.model.relations['db']
+        db_relations = self.charm.model.relations[self._key]
         if len(db_relations) != 1:
             raise RuntimeError('too many relations')
         return db_relations[0]
 
+    def _invalidate(self, _=None):
+        self._endpoint = self._UNREAD
+
     def _on_db_relation_changed(self, event):
-        if self.ready:
-            self.on.ready.emit(event.relation, self._host, self._port)
+        self._invalidate()
+        endpoint = self.endpoint
+        if endpoint:
+            self.on.ready.emit(event.relation, *endpoint)
         else:
-            # data invalid
+            # data invalid or missing
             self.on.broken.emit(event.relation)
 
     @property
-    def _host(self):
-        # read the host from the remote app databag
-        return self.relation.data[self.relation.app]['host']
-
-    @property
-    def _port(self):
-        # read the port from the remote app databag
-        return int(self.relation.data[self.relation.app]['port'])
+    def endpoint(self) -> Optional[DBEndpoint]:
+        """The remote db endpoint, or None if it is missing or invalid.
+
+        The remote app databag is read and validated once, and the result
+        reused until the next db relation event: a hook pays for one
+        relation-get no matter how often this is accessed.
+        """
+        if self._endpoint is self._UNREAD:
+            self._endpoint = self._read_endpoint()
+        return self._endpoint
+
+    def _read_endpoint(self) -> Optional[DBEndpoint]:
+        try:
+            relation = self.relation
+            # read the remote app databag once
+            databag = relation.data[relation.app]
+            tls_port = databag.get('tls-port')
+            return DBEndpoint(databag['host'], int(databag['port']),
+                              int(tls_port) if tls_port else None,
+                              databag.get('ca') if tls_port else None)
+        except (TimeoutError, RuntimeError, KeyError, ValueError) as e:
+            logger.error(e)
+            return None
 
     @property
     def ready(self):
-        try:
-            self._port
-            self._host
-        except (TimeoutError, RuntimeError, KeyError) as e:
-            logger.error(e)
-            return False
-        return True
+        return self.endpoint is not None
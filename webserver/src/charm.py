@@ -8,15 +8,25 @@
 
 import logging
 from pathlib import Path
+from typing import Optional
 
-from ops.charm import CharmBase, PebbleReadyEvent
+from ops.charm import CharmBase
 from ops.framework import StoredState
-from ops.model import ActiveStatus, Container, WaitingStatus
+from ops.model import ActiveStatus, BlockedStatus, Container, WaitingStatus
 from charms.keydb.v0.db import DBRequirer, ReadyEvent, BrokenEvent
-from ops.pebble import Layer
+from ops.pebble import Layer, Plan
 
 logger = logging.getLogger(__name__)
 
+# where the installed webserver requirements are recorded in the container
+DEPENDENCIES_MARKER = '/webserver-dependencies.txt'
+# where the CA of the db TLS endpoint goes in the container
+DB_CA_FILE = '/etc/webserver/db-ca.crt'
+# unix socket of the co-located read replica, on storage both containers mount
+REPLICA_SOCKET = '/var/run/keydb/keydb.sock'
+# the log levels webserver.py accepts
+LOG_LEVELS = ('debug', 'info', 'warning', 'error', 'critical')
+
 
 class WebserverCharm(CharmBase):
     """Charm the service."""
@@ -24,15 +34,22 @@ class WebserverCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self._webserver_key: str = self.config.get('webserver-key', '')
         self.db = DBRequirer(self)
 
-        self._stored.set_default(db_host=None, db_port=None)
+        self._stored.set_default(db_host=None, db_port=None, db_tls_port=None,
+                                 db_ca=None, reconcile_pending=False)
 
-        self.framework.observe(self.on.webserver_pebble_ready, self._on_webserver_pebble_ready)
+        self.framework.observe(self.on.webserver_pebble_ready, self._reconcile)
+        self.framework.observe(self.on.keydb_pebble_ready, self._reconcile)
+        self.framework.observe(self.on.config_changed, self._reconcile)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.db.on.ready, self._on_db_ready)
         self.framework.observe(self.db.on.broken, self._on_db_broken)
 
+    @property
+    def _webserver_key(self) -> str:
+        return self.config.get('webserver-key', '')
+
     @property
     def _db_host(self):
         return self._stored.db_host
@@ -41,55 +58,109 @@ class WebserverCharm(CharmBase):
     def _db_port(self):
         return self._stored.db_port
 
+    @property
+    def _colocated(self) -> bool:
+        """Whether reads go to a replica of the db in the keydb sidecar."""
+        return bool(self.config['colocated-replica'] and self._db_host)
+
     def _on_db_ready(self, event: ReadyEvent):
         self._stored.db_host = event.host
         self._stored.db_port = event.port
-        if not self._restart_webserver(event):
-            event.defer()
+        self._stored.db_tls_port = event.tls_port
+        self._stored.db_ca = event.ca
+        self._reconcile()
 
     def _on_db_broken(self, event: BrokenEvent):
         self._stored.db_host = None
         self._stored.db_port = None
-        if not self._restart_webserver(event):
-            event.defer()
+        self._stored.db_tls_port = None
+        self._stored.db_ca = None
+        self._reconcile()
 
-    def _on_webserver_pebble_ready(self, event: PebbleReadyEvent):
-        """Define and start a workload using the Pebble API.
+    def _on_update_status(self, _):
+        if self._stored.reconcile_pending:
+            self._reconcile()
 
-        You'll need to specify the right entrypoint and environment
-        configuration for your specific workload. Tip: you can see the
-        standard entrypoint of an existing container using docker inspect
+    def _reconcile(self, _=None) -> bool:
+        """Bring the workload in line with the desired state.
 
-        Learn more about Pebble layers at https://github.com/canonical/pebble
+        The desired state is fully determined by config and stored state,
+        so db events need not be deferred: if the container is not
+        reachable yet, we only record that a reconcile is pending, and the
+        next pebble-ready or update-status catches up in a single pass.
+        Nothing is pushed, installed or replanned unless it changed.
         """
-        self._restart_webserver(event)
+        # the workload would refuse to start, and be restarted over and over
+        error = self._config_error()
+        if error:
+            self.unit.status = BlockedStatus(error)
+            return False
 
-    def _restart_webserver(self, _=None):
         container = self.unit.get_container('webserver')
-        if container.can_connect():
-            # ensure the container is set up
-            self._setup_container(container)
-
-            # Get the current layer.
-            current_layer = container.get_plan()
-            new_layer = self._webserver_layer()
-            # Check if there are any changes to layer services.
-            if current_layer.services != new_layer.services:
-                # Changes were made, add the new layer.
-                container.add_layer('webserver', new_layer, combine=True)
-                logging.info("Added updated layer 'webserver' to Pebble plan")
-                # Restart it and report a new status to Juju.
-                container.replan()
-                logging.info("restarted webserver service")
-
-            self.unit.status = ActiveStatus()
-            return True
-        else:
+        replica = self.unit.get_container('keydb')
+        if not container.can_connect() or (self._colocated and not replica.can_connect()):
+            self._stored.reconcile_pending = True
             self.unit.status = WaitingStatus(
                 'Pending webserver restart; waiting for workload container'
             )
             return False
 
+        # the replica goes first, so the webserver finds its socket
+        if self._colocated:
+            self._apply_layer(replica, 'keydb', self._replica_layer())
+        elif replica.can_connect():
+            service = replica.get_services('keydb').get('keydb')
+            if service and service.is_running():
+                replica.stop('keydb')
+                logger.info("stopped keydb replica")
+
+        # ensure the container is set up
+        self._setup_container(container)
+        ca_changed = False
+        if self._stored.db_ca and _read_file(container, DB_CA_FILE) != self._stored.db_ca:
+            container.push(DB_CA_FILE, self._stored.db_ca, make_dirs=True)
+            ca_changed = True
+
+        replanned = self._apply_layer(container, 'webserver', self._webserver_layer())
+        if ca_changed and not replanned:
+            # the CA is only loaded at startup
+            container.restart('webserver')
+            logger.info("restarted webserver service for the new db CA")
+
+        self._stored.reconcile_pending = False
+        self.unit.status = ActiveStatus()
+        return True
+
+    def _config_error(self) -> Optional[str]:
+        """Why the config is invalid, if it is."""
+        if self.config['log-level'].lower() not in LOG_LEVELS:
+            return f"invalid log-level {self.config['log-level']!r}; expected one of {LOG_LEVELS}"
+        if not 0 <= self.config['access-log-sample-rate'] <= 1:
+            return 'access-log-sample-rate must be between 0 and 1'
+        return None
+
+    def _apply_layer(self, container: Container, name: str, layer: Layer) -> bool:
+        """Add `layer` and replan, unless the plan already has it; whether it did."""
+        if not self._plan_differs(container.get_plan(), layer):
+            return False
+        # Changes were made, add the new layer.
+        container.add_layer(name, layer, combine=True)
+        logger.info(f"Added updated layer '{name}' to Pebble plan")
+        # Restart it and report a new status to Juju.
+        container.replan()
+        logger.info(f"restarted {name} service")
+        return True
+
+    @staticmethod
+    def _plan_differs(plan: Plan, layer: Layer) -> bool:
+        """Whether applying `layer` would change any service or check in `plan`."""
+        return any(
+            name not in plan_items or plan_items[name] != item
+            for plan_items, layer_items in ((plan.services, layer.services),
+                                            (plan.checks, layer.checks))
+            for name, item in layer_items.items()
+        )
+
     def _webserver_layer(self) -> Layer:
         # Define an initial Pebble layer configuration
         pebble_layer = {
@@ -99,19 +170,77 @@ class WebserverCharm(CharmBase):
                 "webserver": {
                     "override": "replace",
                     "summary": "webserver",
-                    # the webserver process dumps logs to webserver.log.
-                    "command": "python webserver.py > webserver.log",
+                    # the webserver process logs json to stdout (collected by
+                    # pebble) and to a size-rotated webserver.log.
+                    "command": "python webserver.py",
                     "startup": "enabled",
                     "environment": {
                         'KEY': self._webserver_key,
                         'DB_HOST': self._db_host,
-                        'DB_PORT': self._db_port
+                        'DB_PORT': self._db_port,
+                        'LOG_LEVEL': self.config['log-level'],
+                        'ACCESS_LOG_SAMPLE_RATE': str(self.config['access-log-sample-rate']),
+                        'LOG_FILE': '/webserver.log',
+                        'LOG_MAX_BYTES': str(self.config['log-max-bytes']),
+                        'HOT_KEY_THRESHOLD': str(self.config['hot-key-threshold']),
+                        'HOT_KEY_TTL': str(self.config['hot-key-ttl']),
+                        'READ_BATCH_WINDOW_MS': str(self.config['read-batch-window-ms']),
+                        'WRITE_BEHIND': str(self.config['write-behind']),
+                        'WRITE_BEHIND_FLUSH_MS': str(self.config['write-behind-flush-ms']),
+                        'KEY_INDEX': str(self.config['key-index']),
                     },
+                    # a hung process is restarted by pebble
+                    "on-check-failure": {"webserver-alive": "restart"},
                 }
             },
+            "checks": {
+                "webserver-alive": {
+                    "override": "replace",
+                    "level": "alive",
+                    "period": "10s",
+                    "threshold": 3,
+                    "http": {"url": "http://localhost:8000/healthz"},
+                },
+                "webserver-ready": {
+                    "override": "replace",
+                    "level": "ready",
+                    "period": "10s",
+                    "threshold": 3,
+                    "http": {"url": "http://localhost:8000/readyz"},
+                },
+            },
         }
+        if self._stored.db_tls_port:
+            # talk to the db over TLS, verifying it against the pushed CA
+            pebble_layer['services']['webserver']['environment'].update({
+                'DB_TLS_PORT': str(self._stored.db_tls_port),
+                'DB_CA_FILE': DB_CA_FILE,
+            })
+        if self._colocated:
+            pebble_layer['services']['webserver']['environment']['DB_SOCKET'] = REPLICA_SOCKET
         return Layer(pebble_layer)
 
+    def _replica_layer(self) -> Layer:
+        # a read-only replica of the db, reachable only through the unix
+        # socket (--port 0: no TCP listener); it replicates over the plain
+        # port, and refuses reads until it has synced once.
+        command = (f"keydb-server --port 0 --unixsocket {REPLICA_SOCKET} --unixsocketperm 770"
+                   f" --replicaof {self._db_host} {self._db_port}"
+                   " --replica-read-only yes --replica-serve-stale-data no"
+                   " --save '' --appendonly no --dir /tmp")
+        return Layer({
+            "summary": "keydb replica layer",
+            "description": "pebble config layer for the co-located keydb read replica",
+            "services": {
+                "keydb": {
+                    "override": "replace",
+                    "summary": "co-located keydb read replica",
+                    "command": command,
+                    "startup": "enabled",
+                }
+            },
+        })
+
     @staticmethod
     def _setup_container(container: Container):
         # copy the webserver file to the container. In a production environment,
@@ -119,15 +248,25 @@ class WebserverCharm(CharmBase):
         # 'bare' python container as base.
 
         resources = Path(__file__).parent / 'resources'
-        webserver_source_path = resources / 'webserver.py'
-        with open(webserver_source_path, 'r') as webserver_source:
+        webserver_source = (resources / 'webserver.py').read_text()
+        if _read_file(container, '/webserver.py') != webserver_source:
             logger.info('pushing webserver source...')
             container.push('/webserver.py', webserver_source)
 
         # we install the webserver dependencies; in a production environment, these
         # would typically be baked in the workload OCI image.
-        webserver_dependencies_path = resources / 'webserver-dependencies.txt'
-        with open(webserver_dependencies_path, 'r') as dependencies_file:
-            dependencies = dependencies_file.read().split('\n')
+        # The installed requirements are recorded next to the source, so
+        # that pip only runs again if they change.
+        requirements = (resources / 'webserver-dependencies.txt').read_text()
+        if _read_file(container, DEPENDENCIES_MARKER) != requirements:
+            dependencies = requirements.split()
             logger.info(f'installing webserver dependencies {dependencies}...')
             container.exec(['pip', 'install', *dependencies]).wait()
+            container.push(DEPENDENCIES_MARKER, requirements)
+
+
+def _read_file(container: Container, path: str) -> Optional[str]:
+    """The contents of `path` in the container, or None if it does not exist."""
+    if not container.exists(path):
+        return None
+    return container.pull(path).read()
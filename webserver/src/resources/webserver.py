@@ -1,60 +1,880 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import logging.handlers
 import os
-from typing import Union
+import queue
+import random
+import ssl
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple, Union
 
 import redis as redis
 import uvicorn as uvicorn
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Query, Request
+from fastapi.responses import JSONResponse
 
+# readiness probe tuning: how long a PING may take, and for how long its
+# outcome is reused before KeyDB is pinged again.
+READINESS_TIMEOUT = 0.5
+READINESS_CACHE_TTL = 2.0
 
-def client():
-    DB_PORT = os.environ.get('DB_PORT')
-    DB_HOST = os.environ.get('DB_HOST')
-    if not (DB_HOST and DB_PORT):
+# upper bound on the keys one /keys call may ask the database to look at
+MAX_SCAN_COUNT = 1000
+# sorted set of every key written through this webserver, if KEY_INDEX is on
+KEY_INDEX = '__webserver_key_index__'
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Webserver configuration, read from the environment once at startup."""
+    key: str
+    port: int = 8000
+    db_host: Optional[str] = None
+    db_port: Optional[int] = None
+    # if set, the db is reached over TLS on this port, verified against the CA file
+    db_tls_port: Optional[int] = None
+    db_ca_file: Optional[str] = None
+    # unix socket of a co-located read replica of the db; reads go there
+    db_socket: Optional[str] = None
+    log_level: str = 'INFO'
+    access_log_sample_rate: float = 1.0
+    log_file: Optional[str] = None
+    log_max_bytes: int = 10 * 2 ** 20
+    log_backup_count: int = 3
+    # reads/sec above which a key is pinned in the local cache; 0 disables
+    hot_key_threshold: float = 0.0
+    hot_key_ttl: float = 1.0
+    hot_key_top_n: int = 10
+    # how long reads of different keys wait to be merged into one MGET; 0 disables
+    read_batch_window: float = 0.0
+    read_batch_max_keys: int = 256
+    # buffer /set writes and flush them in pipelined batches
+    write_behind: bool = False
+    write_behind_flush_size: int = 100
+    write_behind_flush_interval: float = 0.005
+    write_behind_max_keys: int = 10000
+    # maintain KEY_INDEX on writes, for fast prefix listings
+    key_index: bool = False
+
+    @property
+    def db_configured(self) -> bool:
+        return bool(self.db_host and self.db_port)
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> 'Settings':
+        """Parse and validate the environment; raise RuntimeError if invalid."""
+        key = environ.get('KEY')
+        if not key:
+            raise RuntimeError('this webserver requires the `KEY` '
+                               'environment variable to be set and to be '
+                               'a nonempty string. For whatever reason.')
+
+        db_host = environ.get('DB_HOST') or None
+        db_port = environ.get('DB_PORT') or None
+        if bool(db_host) != bool(db_port):
+            raise RuntimeError('DB_HOST and DB_PORT must be set together; '
+                               f'got DB_HOST={db_host!r}, DB_PORT={db_port!r}')
+        db_tls_port = environ.get('DB_TLS_PORT') or None
+        db_ca_file = environ.get('DB_CA_FILE') or None
+        if bool(db_tls_port) != bool(db_ca_file):
+            raise RuntimeError('DB_TLS_PORT and DB_CA_FILE must be set together')
+        db_socket = environ.get('DB_SOCKET') or None
+        if db_socket and not db_host:
+            raise RuntimeError('DB_SOCKET is a replica of the db: it requires DB_HOST')
+
+        log_level = environ.get('LOG_LEVEL', 'info').upper()
+        if log_level not in LOG_LEVELS:
+            raise RuntimeError(f'LOG_LEVEL must be one of {LOG_LEVELS}, '
+                               f'not {log_level!r}')
+
+        try:
+            settings = cls(
+                key=key,
+                port=int(environ.get('PORT', cls.port)),
+                db_host=db_host,
+                db_port=int(db_port) if db_port else None,
+                db_tls_port=int(db_tls_port) if db_tls_port else None,
+                db_ca_file=db_ca_file,
+                db_socket=db_socket,
+                log_level=log_level,
+                access_log_sample_rate=float(environ.get('ACCESS_LOG_SAMPLE_RATE', 1)),
+                log_file=environ.get('LOG_FILE') or None,
+                log_max_bytes=int(environ.get('LOG_MAX_BYTES', cls.log_max_bytes)),
+                log_backup_count=int(environ.get('LOG_BACKUP_COUNT', cls.log_backup_count)),
+                hot_key_threshold=float(environ.get('HOT_KEY_THRESHOLD', cls.hot_key_threshold)),
+                hot_key_ttl=float(environ.get('HOT_KEY_TTL', cls.hot_key_ttl)),
+                hot_key_top_n=int(environ.get('HOT_KEY_TOP_N', cls.hot_key_top_n)),
+                read_batch_window=float(environ.get('READ_BATCH_WINDOW_MS', 0)) / 1000,
+                read_batch_max_keys=int(environ.get('READ_BATCH_MAX_KEYS',
+                                                    cls.read_batch_max_keys)),
+                write_behind=environ.get('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'),
+                write_behind_flush_size=int(environ.get('WRITE_BEHIND_FLUSH_SIZE',
+                                                        cls.write_behind_flush_size)),
+                write_behind_flush_interval=float(environ.get('WRITE_BEHIND_FLUSH_MS', 5)) / 1000,
+                write_behind_max_keys=int(environ.get('WRITE_BEHIND_MAX_KEYS',
+                                                      cls.write_behind_max_keys)),
+                key_index=environ.get('KEY_INDEX', '').lower() in ('1', 'true', 'yes'),
+            )
+        except ValueError as e:
+            raise RuntimeError(f'invalid webserver environment: {e}') from e
+        if not 0 <= settings.access_log_sample_rate <= 1:
+            raise RuntimeError('ACCESS_LOG_SAMPLE_RATE must be between 0 and 1')
+        if settings.hot_key_threshold < 0 or settings.hot_key_ttl <= 0:
+            raise RuntimeError('HOT_KEY_THRESHOLD must be >= 0 and HOT_KEY_TTL > 0')
+        if settings.read_batch_window < 0 or settings.read_batch_max_keys < 1:
+            raise RuntimeError('READ_BATCH_WINDOW_MS must be >= 0 '
+                               'and READ_BATCH_MAX_KEYS >= 1')
+        if not (settings.write_behind_flush_interval > 0
+                and 1 <= settings.write_behind_flush_size <= settings.write_behind_max_keys):
+            raise RuntimeError('WRITE_BEHIND_FLUSH_MS must be > 0, and '
+                               'WRITE_BEHIND_FLUSH_SIZE between 1 and WRITE_BEHIND_MAX_KEYS')
+        return settings
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """The process-wide settings; a FastAPI dependency."""
+    return Settings.from_env()
+
+
+# attributes every LogRecord has; anything else was passed via `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Render each log record as a single-line json object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if (record.name == 'uvicorn.access' and isinstance(record.args, tuple)
+                and len(record.args) == 5):
+            client_addr, method, path, http_version, status = record.args
+            entry.update(client=client_addr, method=method, path=path,
+                         http_version=http_version, status=status)
+        for attr, value in vars(record).items():
+            if attr not in _RECORD_ATTRS:
+                entry[attr] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a `rate` fraction of the records it sees."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records untouched.
+
+    The stock QueueHandler renders the message and the traceback before
+    enqueueing, and drops `args` and `exc_info`: the formatter would lose
+    the access log fields, and the request would pay for the formatting.
+    The queue never leaves the process, so the record can go as it is.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(settings: Settings) -> logging.handlers.QueueListener:
+    """Route all logging through a queue drained by a background thread.
+
+    Request handlers only pay for enqueueing a record; formatting and I/O
+    happen on the listener thread. Records go to stdout (collected by
+    Pebble) and, if a log file is configured, to a size-rotated file.
+    """
+    formatter = JSONFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if settings.log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            settings.log_file,
+            maxBytes=settings.log_max_bytes,
+            backupCount=settings.log_backup_count))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [RecordQueueHandler(log_queue)]
+    root.setLevel(settings.log_level)
+
+    # access logs are the bulk of the volume: sample them before they
+    # even reach the queue.
+    logging.getLogger('uvicorn.access').addFilter(
+        SamplingFilter(settings.access_log_sample_rate))
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ResumingSSLConnection(redis.SSLConnection):
+    """A TLS connection that resumes the pool's last TLS session.
+
+    All connections of a pool share one SSLContext, and each reconnect
+    offers the last session the server gave out, so only the first
+    connection (or one after the session expired) pays for a full
+    handshake.
+    """
+
+    def __init__(self, *args, ssl_context: ssl.SSLContext, tls_sessions: dict, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ssl_context = ssl_context
+        self._tls_sessions = tls_sessions
+
+    def _wrap_socket_with_ssl(self, sock):
+        sslsock = self._ssl_context.wrap_socket(
+            sock, server_hostname=self.host,
+            session=self._tls_sessions.get('session'))
+        self._remember_session(sslsock)
+        return sslsock
+
+    def _remember_session(self, sslsock):
+        # with TLS 1.3 the ticket arrives after the handshake, so this is
+        # also done when the connection is closed.
+        if isinstance(sslsock, ssl.SSLSocket) and sslsock.session:
+            self._tls_sessions['session'] = sslsock.session
+
+    def disconnect(self, *args):
+        self._remember_session(self._sock)
+        super().disconnect(*args)
+
+
+@functools.lru_cache(maxsize=None)
+def _client(settings: Settings, socket_timeout: Optional[float]) -> redis.Redis:
+    if settings.db_tls_port:
+        context = ssl.create_default_context(cafile=settings.db_ca_file)
+        pool = redis.ConnectionPool(
+            connection_class=ResumingSSLConnection,
+            host=settings.db_host, port=settings.db_tls_port,
+            socket_connect_timeout=READINESS_TIMEOUT, socket_timeout=socket_timeout,
+            ssl_context=context, tls_sessions={})
+    else:
+        pool = redis.ConnectionPool(host=settings.db_host, port=settings.db_port,
+                                    socket_connect_timeout=READINESS_TIMEOUT,
+                                    socket_timeout=socket_timeout)
+    return redis.Redis(connection_pool=pool)
+
+
+def client(settings: Settings, socket_timeout: Optional[float] = None) -> redis.Redis:
+    """The db client; each `socket_timeout` gets a pool of its own."""
+    if not settings.db_configured:
         raise RuntimeError('required envvars unset')
-    return redis.Redis(host=DB_HOST,
-                       port=int(DB_PORT))
+    return _client(settings, socket_timeout)
 
 
-def check_key():
-    KEY = os.environ.get('KEY')
+@functools.lru_cache(maxsize=None)
+def _replica(settings: Settings, socket_timeout: Optional[float]) -> redis.Redis:
+    return redis.Redis(unix_socket_path=settings.db_socket,
+                       socket_connect_timeout=READINESS_TIMEOUT,
+                       socket_timeout=socket_timeout)
 
-    if not KEY:
-        raise RuntimeError('this webserver requires the `KEY` '
-                           'environment variable to be set and to be '
-                           'a nonempty string. For whatever reason.')
-    return {"message": "ready",
-            "*KEY*": KEY}
 
+def read_client(settings: Settings, socket_timeout: Optional[float] = None) -> redis.Redis:
+    """Where reads go: the co-located replica if any, else the db."""
+    if settings.db_socket:
+        return _replica(settings, socket_timeout)
+    return client(settings, socket_timeout)
+
+
+# (timestamp, outcome) of the last readiness check
+_readiness = (0.0, False)
+
+
+def db_reachable(settings: Settings) -> bool:
+    """Whether KeyDB answers a PING, and the replica, if any, is in sync.
+
+    Blocking, and bounded by READINESS_TIMEOUT per call: a db which
+    accepts connections but does not answer makes it return False rather
+    than hang. The answer is cached for a short while. A replica answers
+    PING even before it has synced, while refusing reads, so it is only
+    counted as ready once its link to the db is up.
+    """
+    global _readiness
+    checked_at, reachable = _readiness
+    now = time.monotonic()
+    if now - checked_at < READINESS_CACHE_TTL:
+        return reachable
+    try:
+        reachable = client(settings, READINESS_TIMEOUT).ping()
+        if reachable and settings.db_socket:
+            replication = read_client(settings, READINESS_TIMEOUT).info('replication')
+            reachable = replication.get('master_link_status') == 'up'
+    except Exception as e:
+        logging.getLogger(__name__).warning('readiness check failed: %s', e)
+        reachable = False
+    _readiness = (now, reachable)
+    return reachable
+
+
+# returned by local lookups that found nothing, as None is a valid value
+MISS = object()
+
+
+class CountMinSketch:
+    """Approximate occurrence counts of keys, in fixed memory.
+
+    Estimates never undercount; they overcount by at most
+    e/width * total with probability 1 - exp(-depth).
+    """
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self._rows = [[0] * width for _ in range(depth)]
+
+    def _cells(self, key: str):
+        for seed, row in enumerate(self._rows):
+            yield row, hash((seed, key)) % self.width
+
+    def add(self, key: str) -> int:
+        """Count one occurrence of `key` and return its new estimate."""
+        estimate = None
+        for row, i in self._cells(key):
+            row[i] += 1
+            estimate = row[i] if estimate is None else min(estimate, row[i])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in self._cells(key))
+
+    def clear(self):
+        for row in self._rows:
+            row[:] = [0] * self.width
+
+
+class HotKeyCache:
+    """Spot the most read keys and pin the hottest ones in a local cache.
+
+    Reads are counted per `window` seconds in a count-min sketch, and the
+    `top_n` heaviest keys of the window are kept aside. A key read more than
+    `threshold` times per second, in this window or the previous one, is
+    hot: its value is served from memory for up to `ttl` seconds instead
+    of hitting the database. A threshold of 0 only tracks, never pins.
+
+    Every key has a write generation, bumped by `invalidate`: a value read
+    from the database is only pinned if no write happened since the read
+    started (see `generation`). Generations live in a fixed array indexed
+    by key hash; two keys sharing a slot only miss some pins.
+    """
+
+    GENERATION_SLOTS = 4096
+
+    def __init__(self, threshold: float, ttl: float, top_n: int,
+                 window: float = 1.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.top_n = top_n
+        self.window = window
+        self._clock = clock
+        self._sketch = CountMinSketch()
+        self._window_start = clock()
+        self._top: Dict[str, int] = {}
+        self._previous_top: Dict[str, int] = {}
+        self._previous_hot: set = set()
+        # key -> (expiry, value)
+        self._pinned: Dict[str, Tuple[float, bytes]] = {}
+        self._generations = [0] * self.GENERATION_SLOTS
+
+    def _rotate(self, now: float):
+        if now - self._window_start < self.window:
+            return
+        if now - self._window_start < 2 * self.window:
+            self._previous_top = self._top
+        else:
+            # nothing was read for a whole window
+            self._previous_top = {}
+        self._previous_hot = {key for key, count in self._previous_top.items()
+                              if self._is_hot(count)}
+        self._sketch.clear()
+        self._top = {}
+        self._pinned = {key: pinned for key, pinned in self._pinned.items()
+                        if pinned[0] > now}
+        self._window_start = now
+
+    def _is_hot(self, count: int) -> bool:
+        return bool(self.threshold) and count >= self.threshold * self.window
+
+    def _track(self, key: str, count: int):
+        if key in self._top or len(self._top) < self.top_n:
+            self._top[key] = count
+            return
+        coldest = min(self._top, key=self._top.get)
+        if count > self._top[coldest]:
+            del self._top[coldest]
+            self._top[key] = count
+
+    def lookup(self, key: str):
+        """Count a read of `key`; return its pinned value, or MISS."""
+        now = self._clock()
+        self._rotate(now)
+        count = self._sketch.add(key)
+        self._track(key, count)
+
+        pinned = self._pinned.get(key)
+        if pinned:
+            expiry, value = pinned
+            if expiry > now:
+                return value
+            del self._pinned[key]
+        return MISS
+
+    def _slot(self, key: str) -> int:
+        return hash(key) % self.GENERATION_SLOTS
+
+    def generation(self, key: str) -> int:
+        """Take before reading `key` from the database; pass to `offer`."""
+        return self._generations[self._slot(key)]
 
-app = FastAPI()
+    def offer(self, key: str, value: bytes, generation: int):
+        """Pin `value`, just read from the database, if `key` is hot.
+
+        Unless `key` was written since `generation` was taken: `value` may
+        then predate the write.
+        """
+        if generation != self.generation(key):
+            return
+        if key in self._previous_hot or self._is_hot(self._sketch.estimate(key)):
+            # only hot keys get in, so the pins are bounded by ~top_n
+            self._pinned[key] = (self._clock() + self.ttl, value)
+
+    def invalidate(self, key: str):
+        self._pinned.pop(key, None)
+        self._generations[self._slot(key)] += 1
+
+    def top(self) -> List[dict]:
+        """The hottest keys, by reads/sec, over the last full window."""
+        counts = self._previous_top or self._top
+        return [{'key': key,
+                 'rate': count / self.window,
+                 'pinned': key in self._pinned}
+                for key, count in sorted(counts.items(), key=lambda kv: -kv[1])]
+
+
+@functools.lru_cache(maxsize=None)
+def get_hot_keys(settings: Settings = Depends(get_settings)) -> HotKeyCache:
+    """The process-wide hot key tracker; a FastAPI dependency."""
+    return HotKeyCache(settings.hot_key_threshold, settings.hot_key_ttl,
+                       settings.hot_key_top_n)
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share it."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.shared = 0  # calls that piggybacked on an in-flight one
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]):
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(call())
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.shared += 1
+        # a caller going away must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _done(self, key: str, future: asyncio.Future):
+        # the key may have been forgotten and called again meanwhile
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def forget(self, key: str):
+        """Make later callers start a new call, rather than join the one in flight."""
+        self._calls.pop(key, None)
+
+
+class ReadBatcher:
+    """Merge the reads of different keys arriving within `window` seconds.
+
+    The first read of a batch arms a timer; when it fires, or once
+    `max_keys` keys are waiting, all of them are fetched with a single
+    `mget` call in a worker thread.
+    """
+
+    def __init__(self, mget: Callable[[List[str]], List[Any]],
+                 window: float, max_keys: int):
+        self._mget = mget
+        self.window = window
+        self.max_keys = max_keys
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._fetches = set()  # keep running fetches from being collected
+        self.batches = 0
+
+    async def get(self, key: str):
+        loop = asyncio.get_running_loop()
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = loop.create_future()
+        if len(self._pending) >= self.max_keys:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        fetch = asyncio.ensure_future(self._fetch(batch))
+        self._fetches.add(fetch)
+        fetch.add_done_callback(self._fetches.discard)
+
+    async def _fetch(self, batch: Dict[str, asyncio.Future]):
+        self.batches += 1
+        keys = list(batch)
+        try:
+            values = await asyncio.get_running_loop().run_in_executor(
+                None, self._mget, keys)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, value in zip(batch.values(), values):
+            if not future.done():
+                future.set_result(value)
+
+
+class KeyReader:
+    """Read keys off the event loop, with as few database calls as possible.
+
+    Concurrent reads of the same key share one call; with batching
+    enabled, reads of different keys are merged into one MGET.
+    """
+
+    def __init__(self, db: Callable[[], redis.Redis],
+                 batch_window: float = 0, batch_max_keys: int = 256):
+        self._db = db
+        self.flights = SingleFlight()
+        self.batcher = None
+        if batch_window:
+            self.batcher = ReadBatcher(lambda keys: db().mget(keys),
+                                       batch_window, batch_max_keys)
+
+    async def _fetch(self, key: str):
+        if self.batcher:
+            return await self.batcher.get(key)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self._db().get(key))
+
+    async def get(self, key: str):
+        return await self.flights.do(key, lambda: self._fetch(key))
+
+    def forget(self, key: str):
+        """Call after writing `key`: reads in flight may predate the write."""
+        self.flights.forget(key)
+
+
+@functools.lru_cache(maxsize=None)
+def get_reader(settings: Settings = Depends(get_settings)) -> KeyReader:
+    """The process-wide key reader; a FastAPI dependency."""
+    return KeyReader(lambda: read_client(settings), settings.read_batch_window,
+                     settings.read_batch_max_keys)
+
+
+class WriteBehindBuffer:
+    """Acknowledge writes right away and persist them in batches.
+
+    Writes are coalesced by key, last write wins, and flushed in one
+    pipeline once `flush_size` keys are waiting or every `flush_interval`
+    seconds, whichever comes first. Once `max_keys` keys are waiting,
+    writes to further keys are refused and counted as dropped. A failed
+    flush puts its writes back, unless they have been overwritten since.
+    With `index`, the flushed keys are also added to KEY_INDEX.
+    """
+
+    def __init__(self, db: Callable[[], redis.Redis], flush_size: int,
+                 flush_interval: float, max_keys: int, index: bool = False):
+        self._db = db
+        self.index = index
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._buffer: Dict[str, Any] = {}
+        self._flushing: Dict[str, Any] = {}
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.stats = {'writes': 0, 'coalesced': 0, 'dropped': 0,
+                      'flushes': 0, 'flushed_keys': 0, 'failed_flushes': 0,
+                      'last_flush_seconds': 0.0, 'max_flush_seconds': 0.0,
+                      'total_flush_seconds': 0.0}
+
+    def put(self, key: str, value) -> bool:
+        """Buffer a write; False if the buffer is full and it was dropped."""
+        if key in self._buffer:
+            self.stats['coalesced'] += 1
+        elif len(self._buffer) >= self.max_keys:
+            self.stats['dropped'] += 1
+            return False
+        self._buffer[key] = value
+        self.stats['writes'] += 1
+        if len(self._buffer) >= self.flush_size:
+            self._wake.set()
+        return True
+
+    def pending(self, key: str):
+        """The buffered value of `key` not yet in the database, or MISS."""
+        if key in self._buffer:
+            return self._buffer[key]
+        return self._flushing.get(key, MISS)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, {}
+        self._flushing = batch
+
+        def write():
+            pipeline = self._db().pipeline(transaction=False)
+            for key, value in batch.items():
+                pipeline.set(key, value)
+            if self.index:
+                pipeline.zadd(KEY_INDEX, dict.fromkeys(batch, 0))
+            pipeline.execute()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+        except Exception as e:
+            logging.getLogger(__name__).error(
+                'write-behind flush of %d keys failed: %s', len(batch), e)
+            self.stats['failed_flushes'] += 1
+            for key, value in batch.items():
+                self._buffer.setdefault(key, value)
+            return
+        finally:
+            self._flushing = {}
+        elapsed = time.perf_counter() - start
+        self.stats['flushes'] += 1
+        self.stats['flushed_keys'] += len(batch)
+        self.stats['last_flush_seconds'] = elapsed
+        self.stats['max_flush_seconds'] = max(elapsed, self.stats['max_flush_seconds'])
+        self.stats['total_flush_seconds'] += elapsed
+
+    async def run(self):
+        """Flush on the size or time trigger, until `stop` is called."""
+        while not self._stopping:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            self._wake.clear()
+            await self.flush()
+
+    def stop(self):
+        """Make `run` return after its current flush.
+
+        Not a cancellation: a flush in progress keeps writing in the
+        executor, so a flush started after it could land first.
+        """
+        self._stopping = True
+        self._wake.set()
+
+    def metrics(self) -> dict:
+        return {**self.stats, 'buffered_keys': len(self._buffer)}
+
+
+def make_write_buffer(settings: Settings) -> Optional[WriteBehindBuffer]:
+    """A write-behind buffer for `settings`, if enabled."""
+    if not settings.write_behind:
+        return None
+    return WriteBehindBuffer(lambda: client(settings),
+                             settings.write_behind_flush_size,
+                             settings.write_behind_flush_interval,
+                             settings.write_behind_max_keys,
+                             settings.key_index)
+
+
+def get_write_buffer(request: Request) -> Optional[WriteBehindBuffer]:
+    """The buffer `lifespan` flushes, if write-behind is on; a FastAPI dependency."""
+    return getattr(request.app.state, 'write_buffer', None)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # created here, once: /set must fill the very buffer that is flushed
+    buffer = app.state.write_buffer = make_write_buffer(get_settings())
+    if not buffer:
+        yield
+        return
+    flusher = asyncio.ensure_future(buffer.run())
+    try:
+        yield
+    finally:
+        buffer.stop()
+        await flusher
+        # don't lose what was acknowledged but not written yet
+        await buffer.flush()
+        app.state.write_buffer = None
+    lost = buffer.metrics()['buffered_keys']
+    if lost:
+        logging.getLogger(__name__).error(
+            'write-behind: %d acknowledged writes could not be persisted', lost)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
-async def home():
+async def home(settings: Settings = Depends(get_settings)):
+    return {"message": "ready",
+            "*KEY*": settings.key}
+
+
+@app.get("/healthz")
+async def healthz():
+    return 'ok'
+
+
+@app.get("/readyz")
+async def readyz(settings: Settings = Depends(get_settings)):
+    # off the event loop: a slow db must not stall /healthz and the rest
+    if not await asyncio.get_running_loop().run_in_executor(None, db_reachable, settings):
+        return JSONResponse('database unreachable', status_code=503)
+    return 'ready'
+
+
+@app.get("/admin/hot-keys")
+async def hot_keys(hot: HotKeyCache = Depends(get_hot_keys)):
+    return {"threshold": hot.threshold,
+            "keys": hot.top()}
+
+
+@app.get("/admin/write-behind")
+async def write_behind(buffer: Optional[WriteBehindBuffer] = Depends(get_write_buffer)):
+    if not buffer:
+        return JSONResponse('write-behind is disabled', status_code=404)
+    return buffer.metrics()
+
+
+def scan_keys(db: redis.Redis, match: Optional[str], count: int,
+              cursor: Optional[str]) -> dict:
+    """One SCAN step: at most `count` keys looked at per call."""
+    next_cursor, keys = db.scan(int(cursor or 0), match=match, count=count)
+    return {"cursor": str(next_cursor) if next_cursor else None,
+            "keys": [key for key in keys if key != KEY_INDEX.encode()]}
+
+
+def indexed_keys(db: redis.Redis, prefix: str, count: int,
+                 cursor: Optional[str]) -> dict:
+    """Keys starting with `prefix`, in order, from KEY_INDEX.
+
+    A lexicographic range on the sorted set: O(log N + count) whatever
+    the size of the keyspace. The cursor is the last key returned.
+    """
+    start = b'(' + cursor.encode() if cursor else b'[' + prefix.encode()
+    # every key with the prefix sorts before prefix + 0xff, which utf-8 never uses
+    stop = b'[' + prefix.encode() + b'\xff'
+    keys = db.zrangebylex(KEY_INDEX, start, stop, start=0, num=count)
+    last = keys[-1].decode() if len(keys) == count else None
+    return {"cursor": last, "keys": keys}
+
+
+@app.get("/keys")
+async def list_keys(match: Optional[str] = None, prefix: Optional[str] = None,
+                    count: int = Query(100, ge=1), cursor: Optional[str] = None,
+                    settings: Settings = Depends(get_settings)):
+    """Page through the keyspace without blocking the database.
+
+    With `prefix` and the key index enabled, list indexed keys by prefix;
+    otherwise SCAN, for `match` (glob) or the prefix. Pass the returned
+    cursor back to get the next page; it is null once done.
+    """
+    count = min(count, MAX_SCAN_COUNT)
+    if prefix is not None and match is not None:
+        return JSONResponse('pass either match or prefix', status_code=400)
     try:
-        return check_key()
-    except RuntimeError:
-        return 'not ready'
+        db = read_client(settings)
+        if prefix is not None and settings.key_index:
+            page = functools.partial(indexed_keys, db, prefix, count, cursor)
+        else:
+            if prefix is not None:
+                match = ''.join(f'\\{c}' if c in '*?[]\\' else c for c in prefix) + '*'
+            page = functools.partial(scan_keys, db, match, count, cursor)
+        return await asyncio.get_running_loop().run_in_executor(None, page)
+    except Exception as e:
+        return str(e)
 
 
 @app.get("/get/{var}")
-async def get_var(var: str):
-    check_key()
+async def get_var(var: str, reader: KeyReader = Depends(get_reader),
+                  hot: HotKeyCache = Depends(get_hot_keys),
+                  buffer: Optional[WriteBehindBuffer] = Depends(get_write_buffer)):
+    if buffer:
+        # read your own writes
+        value = buffer.pending(var)
+        if value is not MISS:
+            return value
+    value = hot.lookup(var)
+    if value is not MISS:
+        return value
+    generation = hot.generation(var)
     try:
-        return client().get(var)
+        value = await reader.get(var)
     except Exception as e:
         return str(e)
+    hot.offer(var, value, generation)
+    return value
 
 
 @app.post("/set/{var}/{value}")
-async def set_var(var: str, value: Union[str, int]):
-    check_key()
+async def set_var(var: str, value: Union[str, int],
+                  settings: Settings = Depends(get_settings),
+                  reader: KeyReader = Depends(get_reader),
+                  hot: HotKeyCache = Depends(get_hot_keys),
+                  buffer: Optional[WriteBehindBuffer] = Depends(get_write_buffer)):
+    if var == KEY_INDEX:
+        return JSONResponse(f'{KEY_INDEX} is reserved', status_code=400)
+    if buffer:
+        if not buffer.put(var, value):
+            return JSONResponse('write-behind buffer full', status_code=503)
+        reader.forget(var)
+        hot.invalidate(var)
+        return 'ok'
     try:
-        client().set(var, value)
+        db = client(settings)
+        if settings.key_index:
+            db.pipeline(transaction=False).set(var, value).zadd(KEY_INDEX, {var: 0}).execute()
+        else:
+            db.set(var, value)
+        reader.forget(var)
+        hot.invalidate(var)
         return 'ok'
     except Exception as e:
         return str(e)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # fail fast on a bad environment, before accepting any request
+    settings = get_settings()
+    listener = configure_logging(settings)
+    try:
+        # log_config=None: keep uvicorn from installing its own
+        # (synchronous) handlers over ours.
+        uvicorn.run(app, host="0.0.0.0", port=settings.port, log_config=None)
+    finally:
+        listener.stop()
@@ -32,8 +32,9 @@ async def test_build_and_deploy(ops_test: OpsTest):
     """
     # build and deploy charm from local source folder
     charm = await ops_test.build_charm(".")
-    resources = {"webserver-image": METADATA["resources"]["webserver-image"][
-        "upstream-source"]}
+    resources = {
+        name: resource["upstream-source"]
+        for name, resource in METADATA["resources"].items()}
     await ops_test.model.deploy(charm, resources=resources,
                                 application_name=APP_NAME)
 
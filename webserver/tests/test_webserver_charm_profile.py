@@ -0,0 +1,95 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Hook latency and cost of the webserver charm through its whole lifecycle.
+# Set HOOK_PROFILE_DIR to keep the per-event cProfile dumps.
+
+import os
+from pathlib import Path
+
+import pytest
+
+import ops.model
+import ops.pebble
+import ops.testing
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+from ops.testing import Harness
+from charm import WebserverCharm
+from hook_profiler import HookProfiler
+
+
+@pytest.fixture(autouse=True)
+def _patch_pebble_exec(mocker):
+    obj = mocker.Mock()
+    obj.wait = lambda: None
+    mocker.patch.object(ops.testing._TestingPebbleClient, 'exec', obj)
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    harness = Harness(WebserverCharm)
+    harness.update_config({'webserver-key': 'super-secret-key'})
+    harness.begin()
+    profiler = HookProfiler(harness)
+
+    harness.container_pebble_ready('webserver')
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '6379'})
+    harness.update_config({'log-level': 'debug'})
+    harness.remove_relation(relation_id)
+
+    yield profiler
+    print(profiler.report())
+    profiler.dump(Path(os.environ.get('HOOK_PROFILE_DIR', tmp_path)))
+    harness.cleanup()
+
+
+def test_all_hooks_profiled(profiler: HookProfiler):
+    assert {'webserver_pebble_ready', 'db_relation_created', 'db_relation_changed',
+            'config_changed', 'db_relation_broken'} <= set(profiler.stats)
+
+
+def test_databag_read_once_per_hook(profiler: HookProfiler):
+    changed = profiler.stats['db_relation_changed']
+    assert changed.hook_tools['relation_get'] <= changed.count
+
+
+def test_workload_set_up_once(profiler: HookProfiler):
+    # Only the pushes and installs are guarded here: the Harness of ops 1.5
+    # returns plans without checks, so in this lifecycle every reconcile
+    # sees a plan change and replans. See test_reconcile_noop_hook.
+    pushes = sum(stats.pebble['push'] for stats in profiler.stats.values())
+    installs = sum(stats.pebble['exec'] for stats in profiler.stats.values())
+    # webserver.py and the installed requirements record, once each
+    assert pushes <= 2
+    assert installs <= 1
+
+
+def test_reconcile_noop_hook(mocker):
+    harness = Harness(WebserverCharm)
+    harness.update_config({'webserver-key': 'super-secret-key'})
+    harness.begin()
+    harness.container_pebble_ready('webserver')
+    # what pebble would return: the plan, checks included
+    mocker.patch.object(ops.model.Container, 'get_plan',
+                        return_value=ops.pebble.Plan(
+                            harness.charm._webserver_layer().to_yaml()))
+    profiler = HookProfiler(harness)
+
+    harness.charm.on.config_changed.emit()
+
+    pebble = profiler.stats['config_changed'].pebble
+    assert pebble['add_layer'] == 0
+    assert pebble['replan_services'] == 0
+    assert pebble['push'] == 0
+    assert pebble['exec'] == 0
+    harness.cleanup()
+
+
+def test_profiles_dumped(profiler: HookProfiler, tmp_path):
+    profiler.dump(tmp_path)
+    assert (tmp_path / 'webserver_pebble_ready.prof').exists()
@@ -5,8 +5,10 @@
 
 import pytest
 import yaml
-from ops.model import ActiveStatus
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 
+import ops.model
+import ops.pebble
 import ops.testing
 
 ops.testing.SIMULATE_CAN_CONNECT = True
@@ -39,13 +41,24 @@ def test_initial_plan(harness: Harness[WebserverCharm]):
             "webserver": {
                 "override": "replace",
                 "summary": "webserver",
-                "command": "python webserver.py > webserver.log",
+                "command": "python webserver.py",
                 "startup": "enabled",
                 "environment": {
                     'KEY': 'super-secret-key',
                     'DB_HOST': None,
-                    'DB_PORT': None
+                    'DB_PORT': None,
+                    'LOG_LEVEL': 'info',
+                    'ACCESS_LOG_SAMPLE_RATE': '1.0',
+                    'LOG_FILE': '/webserver.log',
+                    'LOG_MAX_BYTES': '10485760',
+                    'HOT_KEY_THRESHOLD': '0.0',
+                    'HOT_KEY_TTL': '1.0',
+                    'READ_BATCH_WINDOW_MS': '0.0',
+                    'WRITE_BEHIND': 'False',
+                    'WRITE_BEHIND_FLUSH_MS': '5.0',
+                    'KEY_INDEX': 'False',
                 },
+                "on-check-failure": {"webserver-alive": "restart"},
             }
         }
     }
@@ -75,15 +88,205 @@ def test_plan_after_db_connect(harness: Harness[WebserverCharm]):
             "webserver": {
                 "override": "replace",
                 "summary": "webserver",
-                "command": "python webserver.py > webserver.log",
+                "command": "python webserver.py",
                 "startup": "enabled",
                 "environment": {
                     'KEY': 'super-secret-key',
                     'DB_HOST': host,
-                    'DB_PORT': port
+                    'DB_PORT': port,
+                    'LOG_LEVEL': 'info',
+                    'ACCESS_LOG_SAMPLE_RATE': '1.0',
+                    'LOG_FILE': '/webserver.log',
+                    'LOG_MAX_BYTES': '10485760',
+                    'HOT_KEY_THRESHOLD': '0.0',
+                    'HOT_KEY_TTL': '1.0',
+                    'READ_BATCH_WINDOW_MS': '0.0',
+                    'WRITE_BEHIND': 'False',
+                    'WRITE_BEHIND_FLUSH_MS': '5.0',
+                    'KEY_INDEX': 'False',
                 },
+                "on-check-failure": {"webserver-alive": "restart"},
             }
         }
     }
     assert plan.to_dict() == expected_plan
     assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+
+def test_plan_logging_config(harness: Harness[WebserverCharm]):
+    harness.update_config({'log-level': 'debug',
+                           'access-log-sample-rate': 0.1,
+                           'log-max-bytes': 1024})
+    harness.container_pebble_ready("webserver")
+    plan = harness.get_container_pebble_plan("webserver")
+    service = plan.to_dict()['services']['webserver']
+    assert service['command'] == "python webserver.py"
+    env = service['environment']
+    assert env['LOG_LEVEL'] == 'debug'
+    assert env['ACCESS_LOG_SAMPLE_RATE'] == '0.1'
+    assert env['LOG_MAX_BYTES'] == '1024'
+
+
+def test_health_checks(harness: Harness[WebserverCharm]):
+    checks = harness.charm._webserver_layer().to_dict()['checks']
+    assert checks['webserver-alive']['level'] == 'alive'
+    assert checks['webserver-alive']['http']['url'].endswith('/healthz')
+    assert checks['webserver-ready']['level'] == 'ready'
+    assert checks['webserver-ready']['http']['url'].endswith('/readyz')
+
+
+def test_db_endpoint_read_once_per_event(harness: Harness[WebserverCharm], mocker):
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    relation_get = mocker.spy(harness._backend, 'relation_get')
+    relation_ids = mocker.spy(harness._backend, 'relation_ids')
+
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42'})
+    db = harness.charm.db
+    assert db.ready
+    assert db.endpoint == ('0.0.0.42', 42, None, None)
+    assert relation_get.call_count <= 1
+    assert relation_ids.call_count <= 1
+
+    # a new relation event invalidates the snapshot
+    harness.update_relation_data(relation_id, 'remote-db-app', {'port': 'invalid'})
+    assert not db.ready
+
+
+def test_reconcile_is_noop_when_unchanged(harness: Harness[WebserverCharm], mocker):
+    harness.container_pebble_ready("webserver")
+    container = harness.charm.unit.get_container("webserver")
+    push = mocker.spy(ops.model.Container, 'push')
+    exec_ = ops.testing._TestingPebbleClient.exec
+    exec_.reset_mock()
+    mocker.patch.object(ops.model.Container, 'get_plan',
+                        return_value=ops.pebble.Plan(
+                            harness.charm._webserver_layer().to_yaml()))
+    add_layer = mocker.spy(ops.model.Container, 'add_layer')
+
+    harness.charm.on.config_changed.emit()
+
+    assert container.pull('/webserver.py').read()
+    assert push.call_count == 0
+    assert exec_.call_count == 0
+    assert add_layer.call_count == 0
+
+
+def test_db_events_coalesce_into_pending_reconcile(harness: Harness[WebserverCharm]):
+    # container not reachable yet: the db events are not deferred, they
+    # leave a single pending reconcile behind.
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.1', 'port': '1'})
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42'})
+    assert harness.charm._stored.reconcile_pending
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    assert not list(harness.framework._storage.notices())
+
+    harness.container_pebble_ready("webserver")
+    assert not harness.charm._stored.reconcile_pending
+    plan = harness.get_container_pebble_plan("webserver")
+    assert plan.to_dict()['services']['webserver']['environment']['DB_HOST'] == '0.0.0.42'
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+
+def test_config_changed_updates_plan(harness: Harness[WebserverCharm]):
+    harness.container_pebble_ready("webserver")
+    harness.update_config({'webserver-key': 'rotated-key'})
+    plan = harness.get_container_pebble_plan("webserver")
+    assert plan.to_dict()['services']['webserver']['environment']['KEY'] == 'rotated-key'
+
+
+def test_db_tls(harness: Harness[WebserverCharm]):
+    harness.container_pebble_ready("webserver")
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42',
+                                  'tls-port': '43', 'ca': 'the-ca'})
+
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert env['DB_TLS_PORT'] == '43'
+    assert env['DB_CA_FILE'] == '/etc/webserver/db-ca.crt'
+    container = harness.charm.unit.get_container("webserver")
+    assert container.pull('/etc/webserver/db-ca.crt').read() == 'the-ca'
+
+    # the provider turned TLS off
+    harness.update_relation_data(relation_id, 'remote-db-app', {'tls-port': '', 'ca': ''})
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert 'DB_TLS_PORT' not in env
+
+
+def test_db_ca_rotation_restarts_webserver(harness: Harness[WebserverCharm], mocker):
+    harness.container_pebble_ready("webserver")
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42',
+                                  'tls-port': '43', 'ca': 'old-ca'})
+    # the layer does not change, only the CA file
+    mocker.patch.object(ops.model.Container, 'get_plan',
+                        return_value=ops.pebble.Plan(
+                            harness.charm._webserver_layer().to_yaml()))
+    restart = mocker.spy(ops.model.Container, 'restart')
+
+    harness.update_relation_data(relation_id, 'remote-db-app', {'ca': 'new-ca'})
+    container = harness.charm.unit.get_container("webserver")
+    assert container.pull('/etc/webserver/db-ca.crt').read() == 'new-ca'
+    assert restart.call_count == 1
+
+
+def test_colocated_replica(harness: Harness[WebserverCharm]):
+    harness.update_config({'colocated-replica': True})
+    harness.container_pebble_ready("webserver")
+    harness.container_pebble_ready("keydb")
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42'})
+
+    command = harness.get_container_pebble_plan("keydb").to_dict()['services']['keydb']['command']
+    assert '--port 0 --unixsocket /var/run/keydb/keydb.sock' in command
+    assert '--replicaof 0.0.0.42 42' in command
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert env['DB_SOCKET'] == '/var/run/keydb/keydb.sock'
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+    harness.update_config({'colocated-replica': False})
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert 'DB_SOCKET' not in env
+    assert not harness.charm.unit.get_container("keydb").get_service('keydb').is_running()
+
+
+def test_colocated_replica_waits_for_sidecar(harness: Harness[WebserverCharm]):
+    harness.update_config({'colocated-replica': True})
+    harness.container_pebble_ready("webserver")
+    relation_id = harness.add_relation('db', 'remote-db-app')
+    harness.add_relation_unit(relation_id, 'remote-db-app/0')
+    harness.update_relation_data(relation_id, 'remote-db-app',
+                                 {'host': '0.0.0.42', 'port': '42'})
+    assert harness.charm._stored.reconcile_pending
+
+    harness.container_pebble_ready("keydb")
+    assert not harness.charm._stored.reconcile_pending
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert env['DB_SOCKET'] == '/var/run/keydb/keydb.sock'
+
+
+@pytest.mark.parametrize('config', (
+    {'log-level': 'chatty'},
+    {'access-log-sample-rate': 1.5},
+))
+def test_invalid_logging_config_blocks(harness: Harness[WebserverCharm], config):
+    harness.container_pebble_ready("webserver")
+    harness.update_config(config)
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    # the running workload is left alone
+    env = harness.get_container_pebble_plan("webserver").to_dict()['services']['webserver']['environment']
+    assert env['LOG_LEVEL'] == 'info'
+
+    harness.update_config({'log-level': 'DEBUG', 'access-log-sample-rate': 0.5})
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
@@ -0,0 +1,633 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import asyncio
+import json
+import logging
+import socket
+import ssl
+import threading
+import time
+from unittest import mock
+
+import fakeredis
+import httpx
+import pytest
+import redis
+from fastapi.testclient import TestClient
+
+import webserver
+from webserver import (MISS, CountMinSketch, HotKeyCache, JSONFormatter,
+                       KeyReader, SamplingFilter, Settings, SingleFlight,
+                       WriteBehindBuffer)
+
+
+def _access_record():
+    return logging.LogRecord(
+        'uvicorn.access', logging.INFO, __file__, 0,
+        '%s - "%s %s HTTP/%s" %d',
+        ('10.0.0.1:5000', 'GET', '/get/foo', '1.1', 200), None)
+
+
+@pytest.fixture
+def configured_logging(tmp_path):
+    loggers = [logging.getLogger(name)
+               for name in ('', 'uvicorn', 'uvicorn.error', 'uvicorn.access')]
+    saved = [(logger.handlers, logger.filters, logger.level, logger.propagate)
+             for logger in loggers]
+    log_file = tmp_path / 'webserver.log'
+    listener = webserver.configure_logging(Settings(key='secret', log_file=str(log_file)))
+    yield listener, log_file
+    if listener._thread:
+        listener.stop()
+    for logger, (handlers, filters, level, propagate) in zip(loggers, saved):
+        logger.handlers, logger.filters = handlers, filters
+        logger.level, logger.propagate = level, propagate
+
+
+def test_logging_through_queue(configured_logging):
+    listener, log_file = configured_logging
+    logging.getLogger('uvicorn.access').info(
+        '%s - "%s %s HTTP/%s" %d', '10.0.0.1:5000', 'GET', '/get/foo', '1.1', 200)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logging.getLogger('webserver').exception('request failed')
+    # stopping the listener drains the queue
+    listener.stop()
+    access, error = map(json.loads, log_file.read_text().splitlines())
+    assert access['logger'] == 'uvicorn.access'
+    assert access['message'] == '10.0.0.1:5000 - "GET /get/foo HTTP/1.1" 200'
+    assert access['method'] == 'GET'
+    assert access['path'] == '/get/foo'
+    assert access['status'] == 200
+    assert error['level'] == 'ERROR'
+    assert 'ValueError: boom' in error['exc_info']
+
+
+def test_json_formatter_extra_fields():
+    record = logging.LogRecord('webserver', logging.WARNING, __file__, 0,
+                               'slow call', (), None)
+    record.duration = 0.5
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry['message'] == 'slow call'
+    assert entry['duration'] == 0.5
+
+
+def test_sampling_filter():
+    assert all(SamplingFilter(1).filter(_access_record()) for _ in range(100))
+    assert not any(SamplingFilter(0).filter(_access_record()) for _ in range(100))
+
+
+def test_settings_from_env():
+    settings = Settings.from_env({'KEY': 'secret', 'DB_HOST': '0.0.0.42',
+                                  'DB_PORT': '6379', 'LOG_LEVEL': 'debug'})
+    assert settings.key == 'secret'
+    assert settings.db_port == 6379
+    assert settings.db_configured
+    assert settings.log_level == 'DEBUG'
+
+
+@pytest.mark.parametrize('env', (
+    {},
+    {'KEY': ''},
+    {'KEY': 'secret', 'DB_HOST': '0.0.0.42'},
+    {'KEY': 'secret', 'DB_HOST': '0.0.0.42', 'DB_PORT': 'eighty'},
+    {'KEY': 'secret', 'LOG_LEVEL': 'chatty'},
+    {'KEY': 'secret', 'ACCESS_LOG_SAMPLE_RATE': '2'},
+    {'KEY': 'secret', 'DB_TLS_PORT': '6380'},
+    {'KEY': 'secret', 'DB_SOCKET': '/keydb.sock'},
+))
+def test_settings_invalid(env):
+    with pytest.raises(RuntimeError):
+        Settings.from_env(env)
+
+
+def test_settings_tls():
+    settings = Settings.from_env({'KEY': 'secret', 'DB_HOST': '0.0.0.42', 'DB_PORT': '6379',
+                                  'DB_TLS_PORT': '6380', 'DB_CA_FILE': '/ca.crt'})
+    assert settings.db_tls_port == 6380
+    assert settings.db_ca_file == '/ca.crt'
+
+
+def test_tls_client(monkeypatch):
+    monkeypatch.setattr(webserver.ssl, 'create_default_context', lambda cafile: ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT))
+    settings = Settings(key='secret', db_host='0.0.0.42', db_port=6379,
+                        db_tls_port=6380, db_ca_file='/ca.crt')
+    pool = webserver.client(settings).connection_pool
+    assert pool.connection_class is webserver.ResumingSSLConnection
+    assert pool.connection_kwargs['port'] == 6380
+    # one context and session store for the whole pool
+    assert webserver.client(settings).connection_pool is pool
+
+
+def test_read_client_replica():
+    settings = Settings(key='secret', db_host='0.0.0.42', db_port=6379,
+                        db_socket='/var/run/keydb/keydb.sock')
+    pool = webserver.read_client(settings).connection_pool
+    assert pool.connection_class is redis.UnixDomainSocketConnection
+    assert pool.connection_kwargs['path'] == '/var/run/keydb/keydb.sock'
+    # writes still go to the db
+    assert webserver.client(settings).connection_pool.connection_kwargs['port'] == 6379
+    assert webserver.read_client(Settings(key='secret', db_host='0.0.0.42', db_port=6379)) \
+        is webserver.client(Settings(key='secret', db_host='0.0.0.42', db_port=6379))
+
+
+@pytest.fixture
+def settings():
+    return Settings(key='secret')
+
+
+@pytest.fixture
+def client(monkeypatch, settings):
+    monkeypatch.setattr(webserver, '_readiness', (0.0, False))
+    webserver.app.dependency_overrides[webserver.get_settings] = lambda: settings
+    yield TestClient(webserver.app)
+    webserver.app.dependency_overrides.clear()
+
+
+def test_home(client):
+    assert client.get('/').json() == {'message': 'ready', '*KEY*': 'secret'}
+
+
+def test_healthz(client):
+    assert client.get('/healthz').json() == 'ok'
+
+
+def test_readyz_db_unset(client):
+    assert client.get('/readyz').status_code == 503
+
+
+def test_readyz_caches_ping(client, monkeypatch):
+    pings = []
+    fake_client = mock.Mock()
+    fake_client.ping = lambda: pings.append(1) or True
+    monkeypatch.setattr(webserver, 'client', lambda *_: fake_client)
+    for _ in range(5):
+        resp = client.get('/readyz')
+        assert resp.status_code == 200
+        assert resp.json() == 'ready'
+    assert len(pings) == 1
+
+
+@pytest.mark.parametrize('link, status_code', (('down', 503), ('up', 200)))
+def test_readyz_waits_for_replica_sync(monkeypatch, link, status_code):
+    monkeypatch.setattr(webserver, '_readiness', (0.0, False))
+    db, replica = mock.Mock(), mock.Mock()
+    db.ping.return_value = True
+    # a replica still syncing answers PING all the same
+    replica.ping.return_value = True
+    replica.info.return_value = {'role': 'slave', 'master_link_status': link}
+    monkeypatch.setattr(webserver, 'client', lambda *_: db)
+    monkeypatch.setattr(webserver, 'read_client', lambda *_: replica)
+    settings = Settings(key='secret', db_host='0.0.0.42', db_port=6379,
+                        db_socket='/var/run/keydb/keydb.sock')
+    webserver.app.dependency_overrides[webserver.get_settings] = lambda: settings
+    try:
+        assert TestClient(webserver.app).get('/readyz').status_code == status_code
+    finally:
+        webserver.app.dependency_overrides.clear()
+    replica.info.assert_called_once_with('replication')
+
+
+@pytest.fixture
+def unresponsive_db():
+    # connections complete in the kernel backlog, but nothing ever answers
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        yield sock.getsockname()[1]
+
+
+def test_readyz_unresponsive_db(monkeypatch, unresponsive_db):
+    monkeypatch.setattr(webserver, '_readiness', (0.0, False))
+    settings = Settings(key='secret', db_host='127.0.0.1', db_port=unresponsive_db)
+    webserver.app.dependency_overrides[webserver.get_settings] = lambda: settings
+
+    async def probe():
+        transport = httpx.ASGITransport(app=webserver.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as http:
+            start = time.monotonic()
+            ready = asyncio.ensure_future(http.get('/readyz'))
+            await asyncio.sleep(.05)
+            health = await http.get('/healthz')
+            health_elapsed = time.monotonic() - start
+            return await ready, health, health_elapsed, time.monotonic() - start
+
+    try:
+        ready, health, health_elapsed, ready_elapsed = asyncio.run(probe())
+    finally:
+        webserver.app.dependency_overrides.clear()
+    assert health.status_code == 200
+    # /healthz did not wait for the PING
+    assert health_elapsed < webserver.READINESS_TIMEOUT
+    assert ready.status_code == 503
+    assert ready_elapsed < 4 * webserver.READINESS_TIMEOUT
+
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(width=64, depth=4)
+    for i in range(200):
+        sketch.add(f'cold{i}')
+    for _ in range(50):
+        sketch.add('hot')
+    # never undercounts
+    assert sketch.estimate('hot') >= 50
+    assert sketch.estimate('hot') > sketch.estimate('cold0')
+    sketch.clear()
+    assert sketch.estimate('hot') == 0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hot_key_pinned_and_expires():
+    clock = FakeClock()
+    hot = HotKeyCache(threshold=10, ttl=0.5, top_n=3, clock=clock)
+    assert hot.lookup('foo') is MISS
+    hot.offer('foo', b'bar', hot.generation('foo'))
+    # not hot yet
+    assert hot.lookup('foo') is MISS
+
+    for _ in range(10):
+        hot.lookup('foo')
+    hot.offer('foo', b'bar', hot.generation('foo'))
+    assert hot.lookup('foo') == b'bar'
+
+    clock.now = 0.6
+    assert hot.lookup('foo') is MISS
+
+
+def test_hot_key_invalidate():
+    hot = HotKeyCache(threshold=1, ttl=10, top_n=3)
+    hot.lookup('foo')
+    hot.offer('foo', b'bar', hot.generation('foo'))
+    hot.invalidate('foo')
+    assert hot.lookup('foo') is MISS
+
+
+def test_hot_key_write_during_read_not_pinned():
+    hot = HotKeyCache(threshold=1, ttl=10, top_n=3)
+    hot.lookup('foo')
+    generation = hot.generation('foo')
+    # a /set lands while the read is in flight
+    hot.invalidate('foo')
+    hot.offer('foo', b'old', generation)
+    assert hot.lookup('foo') is MISS
+
+    hot.offer('foo', b'new', hot.generation('foo'))
+    assert hot.lookup('foo') == b'new'
+
+
+def test_hot_key_disabled():
+    hot = HotKeyCache(threshold=0, ttl=10, top_n=3)
+    for _ in range(100):
+        hot.lookup('foo')
+    hot.offer('foo', b'bar', hot.generation('foo'))
+    assert hot.lookup('foo') is MISS
+
+
+def test_hot_key_top_n():
+    clock = FakeClock()
+    hot = HotKeyCache(threshold=0, ttl=1, top_n=2, clock=clock)
+    for key, reads in (('a', 5), ('b', 1), ('c', 3), ('d', 2)):
+        for _ in range(reads):
+            hot.lookup(key)
+    assert [entry['key'] for entry in hot.top()] == ['a', 'c']
+
+    # the last full window is reported, and it stays hot for one more window
+    clock.now = 1.5
+    hot.lookup('b')
+    assert [entry['key'] for entry in hot.top()] == ['a', 'c']
+    assert hot.top()[0]['rate'] == 5
+
+
+def test_get_serves_pinned_key(client, monkeypatch):
+    fake_db = mock.Mock()
+    fake_db.get.return_value = b'bar'
+    monkeypatch.setattr(webserver, 'client', lambda *_: fake_db)
+    hot = HotKeyCache(threshold=2, ttl=10, top_n=3)
+    webserver.app.dependency_overrides[webserver.get_hot_keys] = lambda: hot
+
+    for _ in range(5):
+        assert client.get('/get/foo').json() == 'bar'
+    assert fake_db.get.call_count == 2
+    assert client.get('/admin/hot-keys').json()['keys'][0]['key'] == 'foo'
+
+    client.post('/set/foo/baz')
+    fake_db.get.return_value = b'baz'
+    assert client.get('/get/foo').json() == 'baz'
+
+
+def test_get_set(client, monkeypatch):
+    fake_db = mock.Mock()
+    fake_db.get.return_value = b'bar'
+    monkeypatch.setattr(webserver, 'client', lambda *_: fake_db)
+    assert client.post('/set/foo/bar').json() == 'ok'
+    fake_db.set.assert_called_once_with('foo', 'bar')
+    assert client.get('/get/foo').json() == 'bar'
+
+
+def test_single_flight_shares_call():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(.01)
+        return 'value'
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do('key', call) for _ in range(10)))
+        assert flights.shared == 9
+        # once done, the next call goes through again
+        await flights.do('key', call)
+        return results
+
+    assert asyncio.run(main()) == ['value'] * 10
+    assert len(calls) == 2
+
+
+class SlowDB:
+    """A fake db whose calls block until released, like a busy KeyDB."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.gets = []
+        self.mgets = []
+
+    def get(self, key):
+        self.release.wait(1)
+        self.gets.append(key)
+        return key.upper()
+
+    def mget(self, keys):
+        self.release.wait(1)
+        self.mgets.append(keys)
+        return [key.upper() for key in keys]
+
+
+def test_key_reader_coalesces_same_key():
+    db = SlowDB()
+
+    async def main():
+        reader = KeyReader(lambda: db)
+        reads = asyncio.gather(*(reader.get('foo') for _ in range(20)))
+        await asyncio.sleep(.01)
+        db.release.set()
+        return await reads
+
+    assert asyncio.run(main()) == ['FOO'] * 20
+    assert db.gets == ['foo']
+
+
+def test_key_reader_forget_after_write():
+    db = SlowDB()
+
+    async def main():
+        reader = KeyReader(lambda: db)
+        before_write = asyncio.ensure_future(reader.get('foo'))
+        await asyncio.sleep(.01)
+        # the write completed: what /set does before returning 'ok'
+        reader.forget('foo')
+        after_write = asyncio.ensure_future(reader.get('foo'))
+        await asyncio.sleep(.01)
+        db.release.set()
+        await asyncio.gather(before_write, after_write)
+        assert not reader.flights._calls
+
+    asyncio.run(main())
+    assert db.gets == ['foo', 'foo']
+
+
+@pytest.mark.parametrize('write_behind', (False, True))
+def test_set_forgets_in_flight_reads(client, monkeypatch, write_behind):
+    reader = mock.Mock()
+    webserver.app.dependency_overrides[webserver.get_reader] = lambda: reader
+    if write_behind:
+        buffer = WriteBehindBuffer(mock.MagicMock, flush_size=10, flush_interval=1,
+                                   max_keys=10)
+        webserver.app.dependency_overrides[webserver.get_write_buffer] = lambda: buffer
+    monkeypatch.setattr(webserver, 'client', lambda *_: mock.Mock())
+    assert client.post('/set/foo/bar').json() == 'ok'
+    reader.forget.assert_called_once_with('foo')
+
+
+def test_key_reader_batches_different_keys():
+    db = SlowDB()
+    db.release.set()
+
+    async def main():
+        reader = KeyReader(lambda: db, batch_window=.01, batch_max_keys=3)
+        return await asyncio.gather(*(reader.get(key) for key in 'abcdaa'))
+
+    assert asyncio.run(main()) == list('ABCDAA')
+    assert db.gets == []
+    assert sorted(map(sorted, db.mgets)) == [['a', 'b', 'c'], ['d']]
+
+
+def test_key_reader_propagates_errors():
+    def db():
+        raise RuntimeError('required envvars unset')
+
+    async def main():
+        return await KeyReader(db).get('foo')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
+
+
+def test_write_behind_coalesces_and_flushes():
+    db = mock.MagicMock()
+    pipeline = db.pipeline.return_value
+
+    async def main():
+        buffer = WriteBehindBuffer(lambda: db, flush_size=10, flush_interval=1,
+                                   max_keys=10)
+        for i in range(5):
+            assert buffer.put('counter', i)
+        assert buffer.put('other', 'x')
+        assert buffer.pending('counter') == 4
+        await buffer.flush()
+        assert buffer.pending('counter') is MISS
+        return buffer.metrics()
+
+    metrics = asyncio.run(main())
+    pipeline.set.assert_has_calls([mock.call('counter', 4), mock.call('other', 'x')])
+    pipeline.execute.assert_called_once()
+    assert metrics['coalesced'] == 4
+    assert metrics['flushes'] == 1
+    assert metrics['flushed_keys'] == 2
+
+
+def test_write_behind_drops_when_full():
+    buffer = WriteBehindBuffer(mock.Mock, flush_size=2, flush_interval=1, max_keys=2)
+    assert buffer.put('a', 1)
+    assert buffer.put('b', 1)
+    # existing keys can still be overwritten
+    assert buffer.put('a', 2)
+    assert not buffer.put('c', 1)
+    assert buffer.metrics()['dropped'] == 1
+
+
+def test_write_behind_size_trigger_and_requeue_on_failure():
+    db = mock.MagicMock()
+    db.pipeline.return_value.execute.side_effect = [ConnectionError('down'), None]
+
+    async def main():
+        buffer = WriteBehindBuffer(lambda: db, flush_size=2, flush_interval=60,
+                                   max_keys=10)
+        flusher = asyncio.ensure_future(buffer.run())
+        buffer.put('a', 1)
+        buffer.put('b', 1)  # size trigger: no need to wait for the interval
+        await asyncio.sleep(.05)
+        assert buffer.metrics()['failed_flushes'] == 1
+        assert buffer.pending('a') == 1
+        buffer.put('c', 1)
+        await asyncio.sleep(.05)
+        buffer.stop()
+        await flusher
+        return buffer.metrics()
+
+    metrics = asyncio.run(main())
+    assert metrics['flushed_keys'] == 3
+    assert metrics['buffered_keys'] == 0
+
+
+class SlowPipelineDB:
+    """A fake db whose pipelines block on execute until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.executing = threading.Event()
+        self.writes = []
+        self.in_flight = self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def pipeline(self, transaction=True):
+        db, batch = self, {}
+        pipeline = mock.Mock()
+        pipeline.set.side_effect = batch.__setitem__
+
+        def execute():
+            with db._lock:
+                db.in_flight += 1
+                db.max_in_flight = max(db.max_in_flight, db.in_flight)
+            db.executing.set()
+            db.release.wait(1)
+            with db._lock:
+                db.in_flight -= 1
+                db.writes.append(dict(batch))
+        pipeline.execute.side_effect = execute
+        return pipeline
+
+
+def test_write_behind_shutdown_waits_for_flush_in_progress(monkeypatch):
+    db = SlowPipelineDB()
+    buffer = WriteBehindBuffer(lambda: db, flush_size=1, flush_interval=60, max_keys=10)
+    monkeypatch.setattr(webserver, 'get_settings', lambda: None)
+    monkeypatch.setattr(webserver, 'make_write_buffer', lambda _: buffer)
+
+    async def main():
+        lifespan = webserver.lifespan(webserver.app)
+        await lifespan.__aenter__()
+        buffer.put('k', 'old')
+        await asyncio.get_running_loop().run_in_executor(None, db.executing.wait, 1)
+        buffer.put('k', 'new')
+        shutdown = asyncio.ensure_future(lifespan.__aexit__(None, None, None))
+        await asyncio.sleep(.05)
+        # the flush in progress is waited for, not cancelled
+        assert not shutdown.done()
+        assert buffer.pending('k') == 'new'
+        db.release.set()
+        await shutdown
+
+    asyncio.run(main())
+    # one write at a time, in order: last write wins
+    assert db.writes == [{'k': 'old'}, {'k': 'new'}]
+    assert db.max_in_flight == 1
+
+
+def test_write_behind_through_lifespan(monkeypatch, fake_db):
+    # the real lifespan and dependency, configured from the environment
+    for name, value in {'KEY': 'secret', 'DB_HOST': '0.0.0.42', 'DB_PORT': '6379',
+                        'WRITE_BEHIND': 'true', 'WRITE_BEHIND_FLUSH_MS': '60000'}.items():
+        monkeypatch.setenv(name, value)
+    webserver.get_settings.cache_clear()
+    try:
+        with TestClient(webserver.app) as http:
+            assert http.post('/set/a/1').json() == 'ok'
+            assert fake_db.get('a') is None
+            assert http.get('/get/a').json() == '1'
+            assert http.get('/admin/write-behind').json()['buffered_keys'] == 1
+        # flushed on shutdown
+        assert fake_db.get('a') == b'1'
+        assert webserver.app.state.write_buffer is None
+    finally:
+        webserver.get_settings.cache_clear()
+
+
+def test_set_write_behind(client, monkeypatch):
+    buffer = WriteBehindBuffer(mock.MagicMock, flush_size=10, flush_interval=1,
+                               max_keys=10)
+    webserver.app.dependency_overrides[webserver.get_write_buffer] = lambda: buffer
+    fake_db = mock.Mock()
+    monkeypatch.setattr(webserver, 'client', lambda *_: fake_db)
+
+    assert client.post('/set/foo/bar').json() == 'ok'
+    assert client.get('/get/foo').json() == 'bar'
+    fake_db.set.assert_not_called()
+    fake_db.get.assert_not_called()
+    assert client.get('/admin/write-behind').json()['buffered_keys'] == 1
+
+
+def test_write_behind_disabled(client):
+    assert client.get('/admin/write-behind').status_code == 404
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = fakeredis.FakeRedis()
+    monkeypatch.setattr(webserver, 'client', lambda *_: db)
+    return db
+
+
+def _list_all(client, **params):
+    keys, cursor = [], None
+    while True:
+        if cursor:
+            params['cursor'] = cursor
+        page = client.get('/keys', params=params).json()
+        keys += page['keys']
+        cursor = page['cursor']
+        if not cursor:
+            return sorted(keys)
+
+
+def test_keys_scan(client, fake_db):
+    for i in range(30):
+        client.post(f'/set/user:{i}/x')
+    client.post('/set/other/x')
+    assert len(_list_all(client, count=7)) == 31
+    assert len(_list_all(client, match='user:*', count=7)) == 30
+    assert _list_all(client, prefix='oth') == ['other']
+
+
+@pytest.mark.parametrize('settings', [Settings(key='secret', key_index=True)])
+def test_keys_prefix_index(client, fake_db, settings):
+    for key in ('user:1', 'user:2', 'user:10', 'users', 'other'):
+        client.post(f'/set/{key}/x')
+    assert fake_db.zcard(webserver.KEY_INDEX) == 5
+    assert _list_all(client, prefix='user:', count=2) == ['user:1', 'user:10', 'user:2']
+    # the index itself never shows up
+    assert webserver.KEY_INDEX not in _list_all(client, match='*')
+    assert client.post(f'/set/{webserver.KEY_INDEX}/x').status_code == 400
+
+
+def test_keys_bad_params(client, fake_db):
+    assert client.get('/keys', params={'match': '*', 'prefix': 'a'}).status_code == 400
+    assert client.get('/keys', params={'count': 0}).status_code == 422